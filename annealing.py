@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Asynchronous annealing: the proposals and cooling schedule of optimize(),
+# but with a number of candidates evaluated at the same time by a pool of
+# processes. Whenever an evaluation finishes, its candidate replaces the
+# current values if it is better, the temperature drops by one step, and a
+# new candidate (proposed around the current values) takes its place. There
+# is no barrier, so workers never wait for slow evaluations of others.
+#
+# Which evaluation finishes first depends on timing, so runs with the same
+# seed can differ. Every proposal and result is written to a log (json
+# lines) in the order they were processed, and replay_async() repeats the
+# run from the log, without evaluations, ending in the same result.
+
+# the function the worker processes evaluate, set once by _init_worker
+_func = None
+
+
+def _init_worker(func):
+    global _func
+    _func = func
+
+
+def _evaluate(vals, method, cutoff):
+    if cutoff is None:
+        return _func(vals, method, 0)
+    return _func(vals, method, 0, cutoff = cutoff)
+
+
+# the annealing loop shared by optimize_async and replay_async
+# start(id, vals, cutoff): start evaluating a candidate
+# next_result(): wait for a result, returns (id, badness)
+# record(event): called with every event of the log
+def _anneal(init, badness, mins, maxs, debug, steps, in_flight, seed, prune, start, next_result, record):
+    rng = np.random.RandomState(seed)
+    ranges = maxs - mins
+    vals = np.asarray(init, dtype=float)
+    pending = {}
+    submitted = 0
+    received = 0
+    while True:
+        # keep in_flight candidates evaluated, until all steps are proposed
+        while len(pending) < in_flight and submitted < steps:
+            temp = 0.4 - 0.002 * received
+            vals_new = np.minimum(np.maximum(rng.normal(vals, temp*ranges), mins), maxs)
+            cutoff = badness if prune else None
+            record({'event': 'propose', 'id': submitted, 'temp': temp, 'params': vals_new.tolist()})
+            pending[submitted] = vals_new
+            start(submitted, vals_new, cutoff)
+            submitted += 1
+        if not pending:
+            break
+        candidate, badness_new = next_result()
+        vals_new = pending.pop(candidate)
+        received += 1
+        record({'event': 'result', 'id': candidate, 'badness': badness_new})
+        # a pruned badness is at least the cutoff, which is at least the
+        # current badness, so it is never accepted
+        if badness_new < badness:
+            badness = badness_new
+            vals = vals_new
+            if debug >= 1:
+                print("%f @ temp %f: %s" % (badness, 0.4 - 0.002 * received, str(vals)))
+    return badness, vals
+
+
+# func, init, mins, maxs, method, debug: as for optimize(); func is pickled
+# into every worker process
+# in_flight: number of candidates evaluated at the same time (default: twice
+# the number of processes)
+# processes: number of worker processes (default: all cores)
+# steps: number of candidates, optimize() evaluates 200
+# seed: seed of the proposals
+# prune: pass the current badness as cutoff to func
+# log: file the replay log is written to
+# returns the best badness and parameters found
+def optimize_async(func, init, mins, maxs, method, debug, in_flight = None, processes = None, steps = 200, seed = 0,
+                   prune = False, log = None):
+    mins = np.asarray(mins, dtype=float)
+    maxs = np.asarray(maxs, dtype=float)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if in_flight is None:
+        in_flight = 2 * processes
+    badness = func(np.asarray(init, dtype=float), method, 0)
+    print("%f @ temp %f: %s" % (badness, 0.4, str(init)))
+
+    log_file = open(log, 'w') if log is not None else None
+
+    def record(event):
+        if log_file is not None:
+            log_file.write(json.dumps(event) + '\n')
+
+    record({'event': 'start', 'init': [float(x) for x in init], 'badness': float(badness), 'mins': mins.tolist(),
+            'maxs': maxs.tolist(), 'method': method, 'steps': steps, 'in_flight': in_flight, 'seed': seed,
+            'prune': prune})
+    executor = ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(func,))
+    futures = {}
+    # results that finished together are handed out in the order of their ids
+    ready = []
+
+    def start(candidate, vals, cutoff):
+        futures[executor.submit(_evaluate, vals, method, cutoff)] = candidate
+
+    def next_result():
+        if not ready:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                ready.append((futures.pop(future), float(future.result())))
+            ready.sort(reverse=True)
+        return ready.pop()
+
+    try:
+        result = _anneal(init, badness, mins, maxs, debug, steps, in_flight, seed, prune, start, next_result, record)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        if log_file is not None:
+            log_file.close()
+    return result
+
+
+# repeat a run of optimize_async from its log
+# checks that the proposals are the same as in the log, and raises a
+# ValueError if they aren't (e.g. because the code changed)
+# returns the best badness and parameters found
+def replay_async(log, debug = 0):
+    with open(log) as log_file:
+        events = [json.loads(line) for line in log_file]
+    settings = events[0]
+    proposals = {event['id']: event['params'] for event in events if event['event'] == 'propose'}
+    results = iter([(event['id'], event['badness']) for event in events if event['event'] == 'result'])
+
+    def start(candidate, vals, cutoff):
+        if proposals.get(candidate) != vals.tolist():
+            raise ValueError("candidate %d differs from the log" % candidate)
+
+    def next_result():
+        return next(results)
+
+    return _anneal(settings['init'], settings['badness'], np.array(settings['mins']), np.array(settings['maxs']),
+                   debug, settings['steps'], settings['in_flight'], settings['seed'], settings['prune'], start,
+                   next_result, lambda event: None)
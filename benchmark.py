@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import argparse
+import csv
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from simulate import simulate, simulate_batch
+from optimize import ParamEvaluator, optimize
+
+# Benchmarks on synthetic measurement files.
+#
+# generate_dataset writes a measurement file with any number of strains: the
+# types are drawn from the 48 valid orientation/arrangement codes, the yfp
+# levels are simulated with synthetic_params and multiplied by log-normal
+# noise, and a fraction of the strains has no entries (not clonable).
+#
+# The benchmark times simulate, apply_ruleset, get_badness for the four
+# methods and short optimize runs with a fixed seed, and checks that the fast
+# paths (simulate_batch, the compiled ruleset, the incremental, pruned and
+# batched badness) agree with the reference implementations.
+#
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --check baseline.json
+# --check compares the timings to a saved baseline and fails (exit code 1)
+# if one is slower by more than its threshold (a factor, "default" unless
+# the baseline's "thresholds" has an entry for the benchmark), or if a check
+# fails.
+
+orientations = ["FFF", "FRF", "FFR", "FRR", "RRR", "RRF", "RFF", "RFR"]
+arrangements = ["CLT", "CTL", "LCT", "LTC", "TCL", "TLC"]
+all_types = [o + a for o in orientations for a in arrangements]
+
+# parameters the synthetic measurements are simulated with (inside the
+# ranges, so the optimize runs can find them), the ranges, and the values
+# the optimize runs start from
+                  # truth, min, max, init
+synthetic_params = [(  0.02,  1e-3,   0.2,  0.08), # 0
+                    (  1200,   400,  2000,   700), # 1
+                    (   800,   400,  2000,  1500), # 2
+                    (   600,   400,  2000,  1000), # 3
+                    (  0.05,  1e-5,   0.1,  0.02), # 4
+                    (  0.03,  1e-5,   0.1,  0.07), # 5
+                    (    50,     0,   100,    20), # 6
+                    (    40,     0,   100,    80), # 7
+                    (   0.9,   0.5,     1,   0.7), # 8
+                    (   0.8,   0.5,     1,   0.6), # 9
+                    (   0.1,     0,   0.4,   0.3), # 10
+                    (     1,  0.75,   1.1,   0.9), # 11
+                    (   0.5,   0.0,     1,   0.2), # 12
+                    (   1e6,   5e5,   2e6, 1.5e6), # 13
+                    (   0.2,  -0.2,   0.5,   0.0), # 14
+                    (   0.0,  -0.5,   0.2,  -0.2), # 15
+                    (  -0.1,  -0.5,   0.2,   0.1), # 16
+                    (   0.1,  -0.5,   0.2,  -0.3), # 17
+                    (  -0.2,  -0.5,   0.2,   0.0)] # 18
+truth = np.array([row[0] for row in synthetic_params])
+mins = np.array([row[1] for row in synthetic_params])
+maxs = np.array([row[2] for row in synthetic_params])
+init = np.array([row[3] for row in synthetic_params])
+
+
+# write a measurement file with strains rows to filename
+# the first 48 strains are all the types in order, the others random ones
+# missing: fraction of strains without entries
+# noise: standard deviation of the log-normal measurement noise
+def generate_dataset(filename, strains, missing = 0.1, noise = 0.2, seed = 0):
+    rng = np.random.RandomState(seed)
+    types = [all_types[i % 48] if i < 48 else all_types[rng.randint(48)] for i in range(strains)]
+    valid = rng.uniform(size=strains) >= missing
+    # all types once, to get the simulated levels of every type
+    with open(filename, 'w') as csvfile:
+        writer = csv.writer(csvfile)
+        for t in all_types:
+            writer.writerow([t] + ["1"] * 16)
+    pe = ParamEvaluator(filename)
+    # (48, 4 inducers, 4 times)
+    levels = pe.simulate_population(truth)[0].reshape(48, 4, 4)
+    with open(filename, 'w') as csvfile:
+        writer = csv.writer(csvfile)
+        for t, v in zip(types, valid):
+            if not v:
+                writer.writerow([t] + [""] * 16)
+                continue
+            measured = levels[all_types.index(t)] * np.exp(noise * rng.standard_normal((4, 4)))
+            # the columns are the 4 inducer combinations for each time
+            writer.writerow([t] + ["%f" % x for x in measured.T.reshape(-1)])
+
+
+# the shortest of repeats average times of calling func number times
+def timeit(func, repeats = 3, number = 1):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+# random parameter vectors within the synthetic ranges
+def random_params(count, seed = 0):
+    rng = np.random.RandomState(seed)
+    return mins + rng.uniform(size=(count, len(mins))) * (maxs - mins)
+
+
+# the loss of simulated yfp levels, written out as in the original
+# get_badness, independently of ParamEvaluator.get_loss
+def reference_loss(yfp, measured, method):
+    if method == 0:
+        return (yfp - measured)**2
+    if method == 1:
+        return abs(np.log10(max(yfp, 0.000001)) - np.log10(measured))
+    if method == 2:
+        return abs(yfp - measured)
+    return np.exp(abs(np.log10(max(yfp, 0.000001)) - np.log10(measured)))
+
+
+# the badness of p the way it was computed before any of the fast paths:
+# apply_ruleset and simulate for every strain and inducer combination
+# returns the badness for each of the methods
+def reference_badness(pe, p, methods):
+    badness = np.zeros(len(methods))
+    for typeid in range(pe.strain_count):
+        if not pe.valids[typeid]:
+            continue
+        for iptgatc in range(4):
+            yfps = simulate(pe.apply_ruleset(p, typeid, iptgatc))
+            for i, method in enumerate(methods):
+                badness[i] += sum(reference_loss(yfp, measured, method)
+                                  for yfp, measured in zip(yfps, pe.data[typeid][iptgatc]))
+    return badness
+
+
+# check that the fast paths agree with the reference implementations
+# returns a list of (name, passed, detail)
+def run_checks(filename):
+    checks = []
+    P = random_params(8, seed=1)
+    pe = ParamEvaluator(filename)
+    # (candidates, methods)
+    expected_all = np.array([reference_badness(pe, p, range(4)) for p in P])
+
+    params = np.array([pe.apply_ruleset(p, typeid, iptgatc) for p in P[:2] for typeid, iptgatc in pe.setups])
+    expanded = pe.expand(P[:2]).reshape(-1, 19)
+    checks.append(("compiled ruleset", np.array_equal(params, expanded), "expand == apply_ruleset"))
+
+    scalar = np.array([simulate(row) for row in params[:64]])
+    batch = simulate_batch(params[:64])
+    error = np.max(np.abs(batch - scalar) / np.maximum(np.abs(scalar), 1e-300))
+    checks.append(("simulate_batch", error <= 1e-9, "max relative difference %.3g" % error))
+
+    # coarser steps only approximate the one-minute steps
+    full = simulate_batch(params)
+    for fidelity in (2, 4, 8):
+        error = np.max(np.abs(simulate_batch(params, fidelity) - full) / np.maximum(np.abs(full), 1e-300))
+        checks.append(("simulate_batch, fidelity %d" % fidelity, error <= 5e-3, "max relative difference %.3g" % error))
+
+    # a cutoff only has an effect when simulating one by one
+    one_by_one = ParamEvaluator(filename, batched=False)
+    for method in range(4):
+        expected = expected_all[:, method]
+        incremental = np.array([pe.get_badness(p, method, 0) for p in P])
+        batch = pe.get_badness_batch(P, method)
+        for name, values in (("incremental", incremental), ("batch", batch)):
+            error = np.max(np.abs(values - expected) / np.abs(expected))
+            checks.append(("%s badness, method %d" % (name, method), error <= 1e-9,
+                           "max relative difference %.3g" % error))
+        # an evaluation that doesn't reach the cutoff is complete, one that
+        # stops returns at least the cutoff (and at most the full badness)
+        for factor in (np.inf, 2.0, 0.5):
+            cutoffs = factor * expected[:2]
+            values = np.array([one_by_one.get_badness(p, method, 0, cutoff=cutoff) for p, cutoff in zip(P, cutoffs)])
+            if factor > 1:
+                error = np.max(np.abs(values - expected[:2]) / np.abs(expected[:2]))
+                passed, detail = error <= 1e-9, "max relative difference %.3g" % error
+            else:
+                passed = np.all((values >= cutoffs) & (values <= expected[:2] * (1 + 1e-9)))
+                detail = "partial badness / cutoff %s" % ", ".join("%.3g" % x for x in values / cutoffs)
+            checks.append(("pruned badness, cutoff %g x, method %d" % (factor, method), passed, detail))
+    return checks
+
+
+# time everything on a file with the given number of strains
+# returns a dictionary from the benchmark name to seconds
+def run_timings(filename, strains, repeats, run_optimize):
+    timings = {}
+    pe = ParamEvaluator(filename)
+    P = random_params(64, seed=2)
+    params = pe.expand(P[:1]).reshape(-1, 19)
+
+    if strains == 48:
+        # the simulations don't depend on the number of strains
+        timings['simulate'] = timeit(lambda: simulate(params[0]), repeats, 5)
+        timings['simulate_batch/1000'] = timeit(lambda: simulate_batch(np.tile(params, (1000 // len(params) + 1, 1))[:1000]),
+                                                repeats)
+    timings['apply_ruleset/%d' % strains] = timeit(
+        lambda: [pe.apply_ruleset(P[0], typeid, iptgatc) for typeid, iptgatc in pe.setups], repeats)
+    timings['expand/%d' % strains] = timeit(lambda: pe.expand(P), repeats, 10)
+
+    for method in range(4):
+        # a new candidate each time, so nothing is reused from snapshots
+        candidates = iter(np.tile(P, (repeats * 4 + 1, 1)))
+        timings['get_badness/%d/method %d' % (strains, method)] = timeit(
+            lambda: pe.get_badness(next(candidates), method, 0), repeats, 4)
+        timings['get_badness_batch/%d/method %d' % (strains, method)] = timeit(
+            lambda: pe.get_badness_batch(P, method), repeats) / len(P)
+
+    if run_optimize:
+        for name, fidelity in (('optimize/%d' % strains, None), ('optimize/%d/fidelity' % strains, [(0.1, 8), (0.02, 4)])):
+            np.random.seed(0)
+            start = time.perf_counter()
+            optimize(ParamEvaluator(filename).get_badness, init, mins, maxs, 3, 0, fidelity = fidelity)
+            timings[name] = time.perf_counter() - start
+    return timings
+
+
+# compare timings to a baseline
+# returns a list of (name, ratio, threshold) of all benchmarks in both
+def compare(timings, baseline, threshold = None):
+    thresholds = baseline.get('thresholds', {})
+    default = threshold if threshold is not None else thresholds.get('default', 1.3)
+    comparison = []
+    for name, seconds in sorted(timings.items()):
+        if name in baseline['results']:
+            comparison.append((name, seconds / baseline['results'][name], thresholds.get(name, default)))
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark on synthetic measurement files")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[48, 480, 4800], help="numbers of strains")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-optimize', action='store_true', help="skip the optimize runs")
+    parser.add_argument('--save', help="write the results as baseline to this file")
+    parser.add_argument('--check', help="compare the results to this baseline")
+    parser.add_argument('--threshold', type=float, help="allowed slowdown factor, overrides the baseline default")
+    parser.add_argument('--data', help="keep the synthetic files in this directory")
+    args = parser.parse_args()
+
+    directory = args.data if args.data is not None else tempfile.mkdtemp()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    failed = False
+    timings = {}
+    try:
+        for strains in args.sizes:
+            filename = os.path.join(directory, 'synthetic%d.csv' % strains)
+            generate_dataset(filename, strains)
+            if strains == min(args.sizes):
+                for name, passed, detail in run_checks(filename):
+                    print("%-40s %s (%s)" % (name, "ok" if passed else "FAILED", detail))
+                    failed = failed or not passed
+            # optimize runs take a while, so only on the smallest file
+            results = run_timings(filename, strains, args.repeats, not args.no_optimize and strains == min(args.sizes))
+            for name, seconds in sorted(results.items()):
+                print("%-40s %10.6f s" % (name, seconds))
+            timings.update(results)
+    finally:
+        if args.data is None:
+            shutil.rmtree(directory)
+
+    if args.save is not None:
+        baseline = {'results': timings,
+                    'thresholds': {'default': args.threshold if args.threshold is not None else 1.3},
+                    'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                                    'machine': platform.machine(), 'node': platform.node()}}
+        with open(args.save, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=1, sort_keys=True)
+    if args.check is not None:
+        with open(args.check) as baseline_file:
+            baseline = json.load(baseline_file)
+        for name, ratio, threshold in compare(timings, baseline, args.threshold):
+            regressed = ratio > threshold
+            print("%-40s %6.2fx %s" % (name, ratio, "REGRESSION (> %.2fx)" % threshold if regressed else ""))
+            failed = failed or regressed
+    sys.exit(1 if failed else 0)
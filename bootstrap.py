@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Bootstrap confidence intervals of the parameters.
+#
+# Each resample of the data is a weighting of the measurements: resampling
+# the strains with replacement weights every measurement of a strain by how
+# often the strain was drawn, resampling the timepoints does the same for
+# single measurements. The badness of a resample is the weighted sum of the
+# loss terms, so the simulations of a candidate serve all resamples.
+#
+# bootstrap() fits all resamples at once with one independent annealing chain
+# each, using the proposal and cooling schedule of optimize() with only a few
+# parameters varied at a time (its block option): the chains start close to
+# their optimum, where varying all of them is rarely an improvement. In every
+# step, the candidates of all chains are simulated in one batch (identical
+# candidates only once), each is scored under the weighting of its own chain,
+# and the chain moves to it if that beats its current values. The spread of
+# the fitted parameters over the resamples gives the intervals.
+
+
+# weights of the measurements for each resample
+# unit: 'strains' or 'timepoints', what is drawn with replacement
+# returns a (resamples, setups, 4) array
+def resample_weights(pe, resamples, unit = 'strains', seed = 0):
+    rng = np.random.RandomState(seed)
+    setups = len(pe.setups)
+    if unit == 'strains':
+        valid = np.flatnonzero(pe.valids)
+        counts = np.zeros((resamples, pe.strain_count))
+        counts[:, valid] = rng.multinomial(len(valid), np.full(len(valid), 1.0 / len(valid)), size=resamples)
+        return np.repeat(counts[:, pe.setup_strain, None], 4, axis=2)
+    if unit == 'timepoints':
+        counts = rng.multinomial(setups * 4, np.full(setups * 4, 1.0 / (setups * 4)), size=resamples)
+        return counts.reshape(resamples, setups, 4).astype(float)
+    raise ValueError("unknown resampling unit: %s" % str(unit))
+
+
+# fit the parameters to resamples of the data of pe
+# init, mins, maxs, method: as for optimize(), the chains start at init
+# (usually the fit to the full data)
+# resamples: number of resamples (and chains)
+# unit, seed: see resample_weights, the seed is also used for the proposals
+# block: number of parameters varied per step (None: all of them)
+# window, tol: a fit counts as converged if its badness improved by less than
+# the fraction tol during the last window steps
+# returns a (resamples, n_params) array with the fitted parameters, the
+# badnesses of the resamples and whether each fit converged
+def bootstrap(pe, init, mins, maxs, method, resamples = 50, unit = 'strains', seed = 0, fidelity = 1, debug = 1,
+              block = 3, window = 50, tol = 1e-3):
+    rng = np.random.RandomState(seed)
+    weights = resample_weights(pe, resamples, unit, seed)
+    ranges = maxs - mins
+    # only the parameters that some simulation reads are varied
+    free = np.flatnonzero(pe.class_deps.any(axis=0) & (ranges > 0))
+    vals = np.tile(np.asarray(init, dtype=float), (resamples, 1))
+
+    # badness of the candidates P (resamples, n_params), each under the
+    # weighting of its own chain
+    def score(P):
+        unique, inverse = np.unique(P, axis=0, return_inverse=True)
+        yfps = pe.simulate_population(unique, fidelity)
+        terms = pe.get_loss_terms(yfps, pe.measurements, method, pe.log_measurements)
+        return np.einsum('bst,bst->b', terms[inverse.reshape(-1)], weights)
+
+    badness = score(vals)
+    if debug >= 1:
+        print("%d resamples of the %s, badness at init: %f to %f" %
+              (resamples, unit, np.min(badness), np.max(badness)))
+    # the badnesses of the last window steps
+    history = [badness.copy()]
+    temp = 0.4
+    while temp > 0.0005:
+        candidates = np.clip(rng.normal(vals, temp * ranges), mins, maxs)
+        if block is not None:
+            # keep all but block randomly chosen (non-fixed) parameters of each chain
+            varied = free[np.argsort(rng.uniform(size=(resamples, len(free))), axis=1)[:, :block]]
+            keep = np.ones(vals.shape, dtype=bool)
+            keep[np.arange(resamples)[:, None], varied] = False
+            candidates[keep] = vals[keep]
+        scores = score(candidates)
+        better = scores < badness
+        vals[better] = candidates[better]
+        badness[better] = scores[better]
+        history = history[-window:] + [badness.copy()]
+        if debug >= 2:
+            print("temp %f: %d resamples improved, median badness %f" % (temp, np.count_nonzero(better), np.median(badness)))
+        temp -= 0.002
+    converged = history[0] - badness <= tol * badness
+    if debug >= 1:
+        print("%d of %d fits converged" % (np.count_nonzero(converged), resamples))
+    return vals, badness, converged
+
+
+# percentile intervals of the fitted parameters, containing the fraction
+# level of them
+# returns the arrays of lower and upper bounds
+def intervals(params, level = 0.95):
+    return (np.percentile(params, 50 * (1 - level), axis=0),
+            np.percentile(params, 50 * (1 + level), axis=0))
+
+
+# converged: whether each fit converged (see bootstrap), the number of fits
+# that did not is printed
+# used: which parameters the badness depends on (pe.class_deps.any(axis=0)),
+# the others are printed as not identifiable instead of with an interval
+def print_intervals(params, estimate, level = 0.95, converged = None, used = None):
+    lower, upper = intervals(params, level)
+    print("%d%% intervals from %d resamples:" % (round(100 * level), len(params)))
+    if converged is not None and not np.all(converged):
+        print("%d of the fits didn't converge" % (len(converged) - np.count_nonzero(converged)))
+    for i in range(params.shape[1]):
+        if used is not None and not used[i]:
+            print("%2d: %12g  not identifiable, no simulation depends on it" % (i, estimate[i]))
+        else:
+            print("%2d: %12g  [%12g, %12g]" % (i, estimate[i], lower[i], upper[i]))
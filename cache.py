@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import hashlib
+import sqlite3
+import time
+
+# Persistent cache of badness evaluations across runs.
+#
+# Entries are keyed by the parameter vector (rounded to a number of
+# significant digits), the method, and a description of the dataset and the
+# simulation (see ParamEvaluator.cache_key). They hold the total badness and
+# the badness of each strain. The store is a sqlite file, which handles
+# concurrent access from several worker processes, and is kept below
+# max_entries by dropping the least recently used entries.
+class EvalCache():
+
+    # path: file of the cache
+    # max_entries: maximum number of entries kept
+    # digits: significant digits of the parameters that are part of the key
+    def __init__(self, path, max_entries = 1000000, digits = 10):
+        self.path = path
+        self.max_entries = max_entries
+        self.digits = digits
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        # entries added by this process since the size was last checked
+        self.added = 0
+
+    # the sqlite connection can't be pickled, so every process opens its own
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS evaluations "
+                                    "(key TEXT PRIMARY KEY, badness REAL, strains BLOB, last_used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS evaluations_last_used ON evaluations (last_used)")
+            self.connection.commit()
+        return self.connection
+
+    def key(self, p, method, context):
+        params = ','.join('%.*g' % (self.digits, x) for x in p)
+        return hashlib.sha1(("%s|%d|%s" % (params, method, context)).encode()).hexdigest()
+
+    # returns the total badness and the array of badnesses per strain, or
+    # None if the evaluation isn't in the cache
+    def get(self, p, method, context):
+        key = self.key(p, method, context)
+        connection = self.connect()
+        with connection:
+            row = connection.execute("SELECT badness, strains FROM evaluations WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE evaluations SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return row[0], np.frombuffer(row[1], dtype=float)
+
+    def put(self, p, method, context, badness, strain_badness):
+        key = self.key(p, method, context)
+        connection = self.connect()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?)",
+                               (key, float(badness), np.asarray(strain_badness, dtype=float).tobytes(), time.time()))
+        self.added += 1
+        # counting the entries isn't free, so only check every now and then
+        if self.added >= max(1, self.max_entries // 100):
+            self.added = 0
+            self.evict()
+
+    # drop the least recently used entries beyond max_entries
+    def evict(self):
+        connection = self.connect()
+        with connection:
+            count = connection.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+            if count > self.max_entries:
+                connection.execute("DELETE FROM evaluations WHERE key IN "
+                                   "(SELECT key FROM evaluations ORDER BY last_used LIMIT ?)",
+                                   (count - self.max_entries,))
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        print("cache: %d of %d lookups hit (%.1f%%)" % (self.hits, total, 100.0 * self.hits / max(total, 1)))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import csv
+import hashlib
+import json
+import sys
+
+# Measurement files.
+#
+# The csv files have one row per strain: its type (e.g. FFFCTL) followed by
+# 16 yfp measurements, for each of the times 4, 6, 8 and 10 hours the values
+# without inducers, with aTc, with IPTG and with both. Strains with missing
+# entries couldn't be cloned.
+#
+# compile_dataset turns a csv file into a binary file that can be memory
+# mapped, so evaluators load it instantly and worker processes share its
+# pages. It holds:
+#   types:   (strains,) type strings as bytes
+#   valid:   (strains,) if the strain could be cloned
+#   data:    (strains, 4, 4) measurements, indexed by strain, inducers
+#            (0, 1, 2 or 3 for none, atc, iptg, both) and time; nan if invalid
+#   logdata: log10 of data, used by the ratio-log methods
+# The file starts with MAGIC, the length of the json header as 8 byte
+# little endian integer, and the header, which describes where each array is.
+
+MAGIC = b'GNDATA1\n'
+# alignment of the arrays in the file
+ALIGN = 64
+
+
+# read a csv file
+# returns the dictionary of arrays described above and the sha1 of the file
+def read_csv(filename):
+    with open(filename, 'rb') as datafile:
+        source_hash = hashlib.sha1(datafile.read()).hexdigest()
+    types = []
+    valids = []
+    datalist = []
+    with open(filename, 'r') as csvfile:
+        reader = csv.reader(csvfile)
+        for row in reader:
+            types.append(row[0])
+            entries = row[1:17]
+            valid = len(entries) == 16 and all(entry != "" for entry in entries)
+            valids.append(valid)
+            if valid:
+                rowdata = [float(entry) for entry in entries]
+                datalist.append([rowdata[0:16:4], rowdata[1:16:4], rowdata[2:16:4], rowdata[3:16:4]])
+            else:
+                datalist.append(np.full((4, 4), np.nan))
+    data = np.array(datalist, dtype=float).reshape(-1, 4, 4)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logdata = np.log10(data)
+    arrays = {'types': np.array([t.encode() for t in types], dtype='S%d' % max([len(t) for t in types] + [1])),
+              'valid': np.array(valids, dtype=bool),
+              'data': data,
+              'logdata': logdata}
+    return arrays, source_hash
+
+
+# convert the csv file filename to the binary file output
+def compile_dataset(filename, output):
+    arrays, source_hash = read_csv(filename)
+    header = {'source_hash': source_hash, 'arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header_bytes = json.dumps(header).encode()
+    # the arrays start at the first aligned position after the header
+    start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+    with open(output, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(np.array(len(header_bytes), dtype='<u8').tobytes())
+        outfile.write(header_bytes)
+        for name, array in arrays.items():
+            outfile.seek(start + header['arrays'][name]['offset'])
+            outfile.write(np.ascontiguousarray(array).tobytes())
+        # make sure the file covers the padding of the last array
+        outfile.truncate(start + offset)
+
+
+# memory map a compiled file
+# returns the dictionary of (read-only) arrays and the sha1 of the csv source
+def load_compiled(filename):
+    with open(filename, 'rb') as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a compiled dataset" % filename)
+        length = int(np.frombuffer(infile.read(8), dtype='<u8')[0])
+        header = json.loads(infile.read(length).decode())
+    start = -(-(len(MAGIC) + 8 + length) // ALIGN) * ALIGN
+    arrays = {}
+    for name, info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=info['dtype'])
+        else:
+            arrays[name] = np.memmap(filename, dtype=info['dtype'], mode='r', offset=start + info['offset'], shape=shape)
+    return arrays, header['source_hash']
+
+
+# load a dataset, compiled or csv
+# returns the dictionary of arrays and the sha1 of the csv source
+def load_dataset(filename):
+    with open(filename, 'rb') as infile:
+        compiled = infile.read(len(MAGIC)) == MAGIC
+    if compiled:
+        return load_compiled(filename)
+    return read_csv(filename)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: %s measurements.csv measurements.gnd" % sys.argv[0])
+        sys.exit(1)
+    compile_dataset(sys.argv[1], sys.argv[2])
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import collections
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+# Evaluation on several hosts.
+#
+# A Broker runs in the optimizing process and hands out batches of parameter
+# vectors to workers over TCP. Every worker has its own evaluator (e.g. a
+# ParamEvaluator of the same measurement file), pulls a batch, evaluates it
+# with get_badness_batch and sends the badnesses back. The broker has the
+# same get_badness and get_badness_batch as the evaluators, so it can be
+# passed to optimize() or the population optimizers instead of them.
+#
+# Messages are json objects, each preceded by its length as 4 byte big endian
+# integer. A batch is leased to the worker that pulled it; a worker sends
+# heartbeats while it evaluates, and the batch is handed out again if the
+# worker disconnects or misses heartbeats for lease_timeout seconds. Batches
+# that end up evaluated twice count once.
+#
+# Workers are started with
+#   python distributed.py host:port measurements.csv
+
+
+def send_message(connection, message):
+    data = json.dumps(message).encode()
+    connection.sendall(struct.pack('>I', len(data)) + data)
+
+
+def recv_exactly(connection, size):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+# returns the next message, or None if the connection was closed
+def recv_message(connection):
+    header = recv_exactly(connection, 4)
+    if header is None:
+        return None
+    data = recv_exactly(connection, struct.unpack('>I', header)[0])
+    if data is None:
+        return None
+    return json.loads(data.decode())
+
+
+class Broker():
+
+    # host, port: address to listen on (port 0 picks a free one, see self.port)
+    # dataset: the dataset_hash of the evaluator, workers with a different
+    #          measurement file are rejected (None accepts any)
+    # batch_size: parameter vectors per batch
+    # lease_timeout: seconds without heartbeat after which a batch is re-queued
+    # poll: seconds an idle worker waits for a batch before asking again
+    def __init__(self, host = '', port = 0, dataset = None, batch_size = 16, lease_timeout = 30.0, poll = 1.0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.lease_timeout = lease_timeout
+        self.poll = poll
+        # all of the state below is guarded by this condition
+        self.changed = threading.Condition()
+        self.queue = collections.deque()
+        # id -> (params, method, fidelity) of the batches without result
+        self.batches = {}
+        # id -> badness array of the finished batches
+        self.results = {}
+        # id -> [deadline, worker] of the batches being evaluated
+        self.leases = {}
+        self.next_id = 0
+        self.connections = {}
+        self.closed = False
+        # sent: batches handed out, requeued: of these, handed out again
+        self.sent = 0
+        self.requeued = 0
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(64)
+        self.port = self.server.getsockname()[1]
+        for target in (self.accept, self.monitor):
+            threading.Thread(target=target, daemon=True).start()
+
+    def accept(self):
+        worker = 0
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            worker += 1
+            threading.Thread(target=self.serve, args=(connection, worker), daemon=True).start()
+
+    # hand batches whose lease expired to the next worker
+    def monitor(self):
+        while True:
+            with self.changed:
+                if self.closed:
+                    return
+                now = time.time()
+                for batch_id, (deadline, _) in list(self.leases.items()):
+                    if deadline < now:
+                        self.requeue(batch_id)
+                self.changed.wait(self.lease_timeout / 4)
+
+    # needs self.changed
+    def requeue(self, batch_id):
+        del self.leases[batch_id]
+        if batch_id in self.batches:
+            self.queue.appendleft(batch_id)
+            self.requeued += 1
+            self.changed.notify_all()
+
+    def serve(self, connection, worker):
+        try:
+            hello = recv_message(connection)
+            if hello is None or hello.get('type') != 'hello':
+                return
+            if self.dataset is not None and hello.get('dataset') != self.dataset:
+                send_message(connection, {'type': 'reject', 'reason': "different measurement file"})
+                return
+            with self.changed:
+                self.connections[worker] = connection
+            send_message(connection, {'type': 'welcome'})
+            while True:
+                message = recv_message(connection)
+                if message is None:
+                    return
+                if message['type'] == 'request':
+                    batch = self.lease(worker)
+                    send_message(connection, batch if batch is not None else {'type': 'idle'})
+                elif message['type'] == 'heartbeat':
+                    with self.changed:
+                        lease = self.leases.get(message['id'])
+                        if lease is not None and lease[1] == worker:
+                            lease[0] = time.time() + self.lease_timeout
+                elif message['type'] == 'result':
+                    self.complete(message['id'], message['badness'])
+        except (OSError, ValueError):
+            pass
+        finally:
+            connection.close()
+            with self.changed:
+                self.connections.pop(worker, None)
+                for batch_id, (_, holder) in list(self.leases.items()):
+                    if holder == worker:
+                        self.requeue(batch_id)
+
+    # wait up to poll seconds for a batch and lease it to worker
+    # returns the batch message or None
+    def lease(self, worker):
+        with self.changed:
+            deadline = time.time() + self.poll
+            while not self.queue and not self.closed and time.time() < deadline:
+                self.changed.wait(deadline - time.time())
+            while self.queue:
+                batch_id = self.queue.popleft()
+                # a requeued batch may have been finished by its first worker
+                if batch_id in self.batches:
+                    params, method, fidelity = self.batches[batch_id]
+                    self.leases[batch_id] = [time.time() + self.lease_timeout, worker]
+                    self.sent += 1
+                    return {'type': 'batch', 'id': batch_id, 'params': params, 'method': method, 'fidelity': fidelity}
+        return None
+
+    def complete(self, batch_id, badness):
+        with self.changed:
+            if batch_id in self.batches:
+                del self.batches[batch_id]
+                self.leases.pop(batch_id, None)
+                self.results[batch_id] = np.array(badness, dtype=float)
+                self.changed.notify_all()
+
+    # like ParamEvaluator.get_badness_batch
+    def get_badness_batch(self, P, method, fidelity = 1):
+        P = np.atleast_2d(np.asarray(P, dtype=float))
+        with self.changed:
+            ids = []
+            for start in range(0, len(P), self.batch_size):
+                batch_id = self.next_id
+                self.next_id += 1
+                self.batches[batch_id] = (P[start:start + self.batch_size].tolist(), int(method), int(fidelity))
+                self.queue.append(batch_id)
+                ids.append(batch_id)
+            self.changed.notify_all()
+            while not all(batch_id in self.results for batch_id in ids):
+                self.changed.wait()
+            return np.concatenate([self.results.pop(batch_id) for batch_id in ids])
+
+    # like ParamEvaluator.get_badness; every call is one round trip, so
+    # optimizers evaluating populations benefit much more
+    # cutoff is accepted for optimize(prune = True), but the full badness is
+    # always computed
+    def get_badness(self, p, method, debug, cutoff = None, fidelity = 1):
+        return self.get_badness_batch(p, method, fidelity)[0]
+
+    def workers(self):
+        with self.changed:
+            return len(self.connections)
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            connections = list(self.connections.values())
+            self.changed.notify_all()
+        self.server.close()
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def print_stats(self):
+        print("broker: %d batches handed out, %d of them again after a lost worker" % (self.sent, self.requeued))
+
+
+# evaluate batches from the broker at host:port until it closes
+# evaluator: has get_badness_batch(P, method, fidelity), e.g. a ParamEvaluator
+# heartbeat: seconds between heartbeats while evaluating a batch
+def run_worker(evaluator, host, port, heartbeat = 5.0, name = None, debug = 1):
+    connection = socket.create_connection((host, port))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # the heartbeat thread sends while the main thread evaluates
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            send_message(connection, message)
+
+    def beat(batch_id, stop):
+        while not stop.wait(heartbeat):
+            try:
+                send({'type': 'heartbeat', 'id': batch_id})
+            except OSError:
+                return
+
+    name = name if name is not None else "%s:%d" % (socket.gethostname(), os.getpid())
+    send({'type': 'hello', 'name': name, 'dataset': getattr(evaluator, 'dataset_hash', None)})
+    reply = recv_message(connection)
+    if reply is None or reply['type'] != 'welcome':
+        raise ValueError("broker refused %s: %s" % (name, reply['reason'] if reply else "connection closed"))
+    evaluated = 0
+    try:
+        while True:
+            send({'type': 'request'})
+            message = recv_message(connection)
+            if message is None:
+                break
+            if message['type'] != 'batch':
+                continue
+            stop = threading.Event()
+            beater = threading.Thread(target=beat, args=(message['id'], stop), daemon=True)
+            beater.start()
+            try:
+                badness = evaluator.get_badness_batch(np.array(message['params']), message['method'], message['fidelity'])
+            finally:
+                stop.set()
+                beater.join()
+            send({'type': 'result', 'id': message['id'], 'badness': [float(b) for b in badness]})
+            evaluated += len(badness)
+    except OSError:
+        pass
+    finally:
+        connection.close()
+    if debug >= 1:
+        print("%s: evaluated %d parameter vectors" % (name, evaluated))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: %s host:port measurements.csv" % sys.argv[0])
+        sys.exit(1)
+    from optimize import ParamEvaluator
+    host, port = sys.argv[1].rsplit(':', 1)
+    run_worker(ParamEvaluator(sys.argv[2]), host, int(port))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from optimize import ParamEvaluator
+
+# Joint fitting of several measurement files.
+#
+# The simulated yfp levels only depend on the parameters and the strain type
+# (through the ruleset), not on the file they are compared to. MultiEvaluator
+# loads every file into its own ParamEvaluator, merges the classes of
+# identical setups of all of them, simulates each of these classes once per
+# candidate and computes the weighted sum of the badnesses of all files from
+# the same simulations.
+class MultiEvaluator():
+
+    # datasets: list of (filename, weight) pairs
+    # the other arguments are passed on to every ParamEvaluator
+    def __init__(self, datasets, **kwargs):
+        self.evaluators = [ParamEvaluator(filename, **kwargs) for filename, _ in datasets]
+        self.filenames = [filename for filename, _ in datasets]
+        self.weights = np.array([weight for _, weight in datasets], dtype=float)
+        self.n_params = self.evaluators[0].n_params
+
+        # merge the classes of all files
+        rules = np.vstack([np.hstack((pe.class_const, pe.class_src)) for pe in self.evaluators])
+        _, representatives, union = np.unique(rules, axis=0, return_index=True, return_inverse=True)
+        union = union.reshape(-1)
+        self.class_const = np.vstack([pe.class_const for pe in self.evaluators])[representatives]
+        self.class_src = np.vstack([pe.class_src for pe in self.evaluators])[representatives]
+        self.class_count = len(representatives)
+        # for every file, the merged class of each of its setups
+        self.setup_class = []
+        start = 0
+        for pe in self.evaluators:
+            self.setup_class.append(union[start:start + pe.class_count][pe.setup_class])
+            start += pe.class_count
+        separate = sum(pe.class_count for pe in self.evaluators)
+        # number of simulations saved per candidate compared to separate evaluators
+        self.sims_saved = separate - self.class_count
+
+    def print_dedup_stats(self):
+        print("%d files with %d classes together, %d simulations saved per candidate" %
+              (len(self.evaluators), self.class_count, self.sims_saved))
+
+    # simulate the merged classes for a population of parameter vectors
+    # returns a (N, classes, 4) array with the simulated yfp levels
+    def simulate_population(self, P, fidelity = 1):
+        P = np.atleast_2d(P)
+        padded = np.hstack((P, np.zeros((len(P), 1))))
+        params = (self.class_const + padded[:, self.class_src]).reshape(-1, 19)
+        yfps = self.evaluators[0].run_simulations(params, fidelity)
+        return yfps.reshape(len(P), self.class_count, 4)
+
+    # badness of every file for a population of parameter vectors
+    # returns a (N, files) array of unweighted badnesses
+    def get_dataset_badness_batch(self, P, method, fidelity = 1):
+        class_yfps = self.simulate_population(P, fidelity)
+        badnesses = []
+        for pe, setup_class in zip(self.evaluators, self.setup_class):
+            losses = pe.get_loss(class_yfps[:, setup_class], pe.measurements, method, pe.log_measurements)
+            badnesses.append(np.sum(losses, axis=1))
+        return np.array(badnesses).T
+
+    # like ParamEvaluator.get_badness_batch, with the weighted sum over the files
+    def get_badness_batch(self, P, method, fidelity = 1):
+        return self.get_dataset_badness_batch(P, method, fidelity).dot(self.weights)
+
+    # like ParamEvaluator.get_badness, with the weighted sum over the files
+    # debug >= 2 prints the badness of each file, debug >= 3 also returns them
+    # cutoff is accepted for optimize(prune = True), but the full badness is
+    # always computed (which is a valid answer to a cutoff query)
+    def get_badness(self, p, method, debug, cutoff = None, fidelity = 1):
+        badnesses = self.get_dataset_badness_batch(p, method, fidelity)[0]
+        badness_total = badnesses.dot(self.weights)
+        if debug >= 2:
+            for filename, weight, badness in zip(self.filenames, self.weights, badnesses):
+                print("%s: %f (weight %f)" % (filename, badness, weight))
+        if debug >= 3:
+            return badness_total, list(badnesses)
+        return badness_total
@@ -1,56 +1,133 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import itertools
-import csv
-import matplotlib.pyplot as plt
-from simulate import simulate
+import hashlib
+import os
+import pickle
+import signal
+import time
+from simulate import simulate, simulate_batch, simulate_batch_sensitivities, simulate_ode, simulate_ode_batch
+from tempering import optimize_tempering
+from annealing import optimize_async
+from population import optimize_cmaes, optimize_de
+from surrogate import Surrogate
+from cache import EvalCache
+from bootstrap import bootstrap, print_intervals
+from dataset import load_dataset
+from distributed import Broker
+from report import render_report
+from results import ResultsStore
+from telemetry import telemetry
+from sweep import run_sweep, sensitivity_indices, print_sensitivity
 from cmath import log
 from operator import truediv
 
 
 class ParamEvaluator(): 
     
-    def __init__(self, filename):
-        # string representation of the 48 types
-        self.types = []
-        # if the type was clonable
-        self.valids = []
+    # filename: csv file with the measurements, or a binary file compiled from
+    # one with dataset.py (which loads instantly and is shared between processes)
+    # batched: simulate all setups at once with simulate_batch instead of
+    # calling the reference simulate() for each of them
+    # integrator: 'discrete' for the one-minute recurrence of simulate(), or
+    # 'ode' for the continuous-time model with adaptive steps (simulate_ode)
+    # cache: an EvalCache that is consulted before simulating
+    def __init__(self, filename, batched = True, integrator = 'discrete', cache = None):
+        self.batched = batched
+        self.integrator = integrator
+        self.cache = cache
+        # tolerances of the adaptive integrator
+        self.rtol = 1e-4
+        self.atol = 1e-6
         # all the 6 different adjacencies are assigned a number
         self.adjdict = {'LT' : 0, 'LC' : 1, 'TC' : 2,
                         'TL' : 0, 'CL' : 1, 'CT' : 2}
         self.protdict = {'L' : 0, 'T' : 1, 'C' : 2}
         self.plotx = list(range(4*60, 10*60+1, 2*60))
 
+        # the hash of the csv source identifies the data, whichever format it was loaded from
+        arrays, self.dataset_hash = load_dataset(filename)
+        # string representation of the 48 types
+        self.types = np.asarray(arrays['types']).astype(str).tolist()
+        # if the type was clonable
+        self.valids = np.asarray(arrays['valid'], dtype=bool).tolist()
         # data: 3D array with yfp expression levels for each type
         # first index: typeid
         # second index: 0, 1, 2 or 3 for wo, atc, iptg, both
         # third index: 0, 1, 2 or 3 for after 4, 6, 8 or 10 hours
-        datalist = []
-        
-        # Number of strains in the data file (can be different than 48 for test files, expected atc file or wt etc... 
-        strain_count = 0
-
-        with open(filename, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                #print row[0]
-                self.types.append(row[0])
-                strain_count += 1
-                rowdata = []
-                valid = True
-                for entry in row[1:17]:
-                    #print entry
-                    if entry == "":
-                        valid = False
-                        break
-                    else:
-                        rowdata.append(float(entry))
-                self.valids.append(valid)
-                datalist.append([rowdata[0:16:4], rowdata[1:16:4], rowdata[2:16:4], rowdata[3:16:4]])
-        
-        
-        self.data = np.array(datalist)
-        self.strain_count = strain_count
+        # (nan for types that weren't clonable)
+        self.data = arrays['data']
+        self.logdata = arrays['logdata']
+        # Number of strains in the data file (can be different than 48 for test files, expected atc file or wt etc...
+        self.strain_count = len(self.types)
+
+        # all the cloneable (typeid, iptgatc) setups that are simulated
+        valid = np.flatnonzero(self.valids)
+        # the strain each setup belongs to
+        self.setup_strain = np.repeat(valid, 4)
+        setup_iptgatc = np.tile(np.arange(4), len(valid))
+        self.setups = list(zip(self.setup_strain.tolist(), setup_iptgatc.tolist()))
+        # the measurements for each of these setups; if all strains are
+        # clonable, these are views of the (possibly memory mapped) data
+        if len(valid) == self.strain_count:
+            self.measurements = self.data.reshape(-1, 4)
+            self.log_measurements = self.logdata.reshape(-1, 4)
+        else:
+            self.measurements = self.data[valid].reshape(-1, 4)
+            self.log_measurements = self.logdata[valid].reshape(-1, 4)
+
+        # number of optimizer parameters the ruleset reads
+        self.n_params = 19
+        # the ruleset only depends on the type string and the inducers, so it
+        # is compiled once for each type that occurs (with its first strain)
+        # into a constant and a gather index, and handed to the setups
+        _, first, setup_type = np.unique(np.asarray(arrays['types'])[valid], return_index=True, return_inverse=True)
+        type_const = np.zeros((len(first), 4, 19))
+        type_src = np.zeros((len(first), 4, 19), dtype=int)
+        for t, strain in enumerate(valid[first]):
+            for iptgatc in range(4):
+                type_const[t, iptgatc], type_src[t, iptgatc] = self.compile_ruleset(strain, iptgatc)
+        type_rules = np.repeat(setup_type.reshape(-1), 4) * 4 + setup_iptgatc
+        type_const = type_const.reshape(-1, 19)
+        type_src = type_src.reshape(-1, 19)
+        self.rule_const = type_const[type_rules]
+        self.rule_src = type_src[type_rules]
+
+        # setups with the same compiled ruleset get the same simulation parameters
+        # for every p, so only one representative of each class is simulated
+        rules = np.hstack((type_const, type_src))
+        _, representatives, rule_class = np.unique(rules, axis=0, return_index=True, return_inverse=True)
+        self.setup_class = rule_class.reshape(-1)[type_rules]
+        self.class_const = type_const[representatives]
+        self.class_src = type_src[representatives]
+        self.class_count = len(representatives)
+        # number of simulations saved per candidate
+        self.sims_saved = len(self.setups) - self.class_count
+
+        # the setups of each strain
+        first_setup = np.full(self.strain_count, -1)
+        first_setup[valid] = np.arange(0, len(self.setups), 4)
+        self.strain_setups = [np.arange(i, i + 4) if i >= 0 else np.zeros(0, dtype=int) for i in first_setup]
+        # running average of each strain's contribution to the badness, used to
+        # evaluate the worst strains first when there is a cutoff
+        self.strain_weight = np.zeros(self.strain_count)
+        # number of strains evaluated and skipped by evaluations with a cutoff
+        self.strains_evaluated = 0
+        self.strains_skipped = 0
+
+        # which entries of p each class depends on
+        self.class_deps = np.zeros((self.class_count, self.n_params + 1), dtype=bool)
+        self.class_deps[np.arange(self.class_count)[:, None], self.class_src] = True
+        self.class_deps = self.class_deps[:, :self.n_params]
+        # the yfp levels of all classes for the most recently used parameter
+        # vectors; a new p only needs to re-simulate the classes that depend
+        # on an entry in which it differs from one of them
+        self.incremental = True
+        self.snapshots = []
+        self.max_snapshots = 2
+        # number of class simulations done and reused from snapshots
+        self.classes_simulated = 0
+        self.classes_reused = 0
 
   
     # p: parameters that determine the strength of the effect of the rules
@@ -114,37 +191,260 @@ class ParamEvaluator():
         return params
 
 
+    # the deviation of simulated yfp levels from the measurements
+    # yfps and measurements are arrays whose last axis are the 4 time points
+    # log_measurements: log10 of the measurements, if they are known already
+    # returns the badness summed over that last axis
+    def get_loss(self, yfps, measurements, method, log_measurements = None):
+        with telemetry.timer('loss'):
+            return np.sum(self.get_loss_terms(yfps, measurements, method, log_measurements), axis=-1)
+
+    # the loss of every single measurement (same shape as yfps)
+    def get_loss_terms(self, yfps, measurements, method, log_measurements = None):
+        if log_measurements is None and (method == 1 or method == 3):
+            log_measurements = np.log10(measurements)
+        if method == 0:
+            return (yfps-measurements)**2
+        elif method == 1:
+            yfps = np.maximum(yfps, 0.000001)
+            return np.abs(np.log10(yfps) - log_measurements)
+        elif method == 2:
+            return abs(yfps-measurements)
+        elif method == 3:
+            yfps = np.maximum(yfps, 0.000001)
+            return np.exp(np.abs(np.log10(yfps) - log_measurements))
+        raise ValueError("unknown method: %s" % str(method))
+
+    # derivative of get_loss with respect to the simulated yfp levels
+    # (elementwise, same shape as yfps)
+    def get_loss_grad(self, yfps, measurements, method, log_measurements = None):
+        if log_measurements is None and (method == 1 or method == 3):
+            log_measurements = np.log10(measurements)
+        if method == 0:
+            return 2 * (yfps-measurements)
+        elif method == 2:
+            return np.sign(yfps-measurements)
+        elif method == 1 or method == 3:
+            # the clamp at 0.000001 has no derivative below it
+            clamped = np.maximum(yfps, 0.000001)
+            ratio = np.log10(clamped) - log_measurements
+            grad = np.sign(ratio) / (clamped * np.log(10)) * (yfps > 0.000001)
+            if method == 3:
+                grad *= np.exp(np.abs(ratio))
+            return grad
+        raise ValueError("unknown method: %s" % str(method))
+
+    # the ruleset is affine in p: every simulation parameter is a constant
+    # plus at most one entry of p. Find out which one by applying the ruleset
+    # to zero and unit vectors.
+    # returns the constant and, for every simulation parameter, the index of the
+    # entry of p that is added to it (n_params if none)
+    def compile_ruleset(self, typeid, iptgatc):
+        const = self.apply_ruleset(np.zeros(self.n_params), typeid, iptgatc)
+        src = np.full(19, self.n_params)
+        for k in range(self.n_params):
+            unit = np.zeros(self.n_params)
+            unit[k] = 1
+            delta = self.apply_ruleset(unit, typeid, iptgatc) - const
+            for j in np.nonzero(delta)[0]:
+                if delta[j] != 1 or src[j] != self.n_params:
+                    raise ValueError("ruleset for %s is not a plain gather/add of p" % self.types[typeid])
+                src[j] = k
+        return const, src
+
+    # expand a population of parameter vectors to the simulation parameters
+    # of every setup, equivalent to calling apply_ruleset for each of them
+    # P: (N, n_params) array
+    # classes: only expand one representative per class of identical setups
+    # returns a (N, setups, 19) or (N, classes, 19) array
+    def expand(self, P, classes = False):
+        P = np.atleast_2d(P)
+        with telemetry.timer('ruleset'):
+            # append a column of zeros for the simulation parameters that are constant
+            padded = np.hstack((P, np.zeros((len(P), 1))))
+            if classes:
+                return self.class_const + padded[:, self.class_src]
+            return self.rule_const + padded[:, self.rule_src]
+
+    # simulate all setups for a population of parameter vectors
+    # P: (N, n_params) array, one candidate per row
+    # fidelity: 1 for full accuracy, higher for coarser and faster simulations
+    # returns a (N, setups, 4) array with the simulated yfp levels
+    def simulate_population(self, P, fidelity = 1):
+        P = np.atleast_2d(P)
+        # get the parameters for one setup of each class via the compiled ruleset
+        params = self.expand(P, classes = True).reshape(-1, 19)
+        yfps = self.run_simulations(params, fidelity)
+        # hand the result of each class to all of its setups
+        return yfps.reshape(len(P), self.class_count, 4)[:, self.setup_class]
+
+    # simulate some of the classes for a single parameter vector p
+    # returns a (len(classes), 4) array with the simulated yfp levels
+    def simulate_classes(self, p, classes, fidelity = 1):
+        with telemetry.timer('ruleset'):
+            padded = np.append(p, 0)
+            params = self.class_const[classes] + padded[self.class_src[classes]]
+        return self.run_simulations(params, fidelity)
+
+    # get the simulated yfp levels for a (K, 19) array of simulation parameters,
+    # either all at once or one by one
+    # fidelity n means n-minute steps for the discrete model, and n times looser
+    # tolerances for the adaptive integrator
+    def run_simulations(self, params, fidelity = 1):
+        if len(params) == 0:
+            return np.zeros((0, 4))
+        telemetry.count('simulations', len(params))
+        with telemetry.timer('simulate'):
+            if self.integrator == 'ode':
+                rtol, atol = self.rtol * fidelity, self.atol * fidelity
+                if self.batched:
+                    return simulate_ode_batch(params, rtol = rtol, atol = atol)[0]
+                return np.array([simulate_ode(row, rtol = rtol, atol = atol) for row in params])
+            elif self.batched or fidelity != 1:
+                return simulate_batch(params, fidelity)
+            else:
+                return np.array([simulate(row) for row in params])
+
+    # whether run_simulations simulates the classes one at a time; only then
+    # can a cutoff save simulations, a simulate_batch pass costs about as
+    # much for a few classes as for all of them
+    def one_by_one(self, fidelity = 1):
+        return not self.batched and (self.integrator == 'ode' or fidelity == 1)
+
+    # what, apart from p and the method, determines a cached badness: the
+    # dataset, the ruleset and how the simulations are done
+    # (the simulation code itself isn't part of it, so delete the cache file
+    # when the model changes)
+    def cache_context(self, fidelity):
+        rules = hashlib.sha1(self.rule_const.tobytes() + self.rule_src.tobytes()).hexdigest()
+        if self.integrator == 'ode':
+            simulation = "ode %g %g" % (self.rtol * fidelity, self.atol * fidelity)
+        else:
+            simulation = "discrete %d" % fidelity
+        return "%s|%s|%s" % (self.dataset_hash, rules, simulation)
+
+    # the classes affected by changing the given entries of p
+    def affected_classes(self, changed):
+        return np.flatnonzero(self.class_deps[:, changed].any(axis=1))
+
+    # find the snapshot (of the same fidelity) p differs least from
+    # returns the yfp levels of all classes with the ones that have to be
+    # re-simulated left at 0, a mask of the classes that are already known,
+    # and the snapshot that was used (None if none was)
+    def snapshot_base(self, p, fidelity = 1):
+        class_yfps = np.zeros((self.class_count, 4))
+        known = np.zeros(self.class_count, dtype=bool)
+        if not self.incremental:
+            return class_yfps, known, None
+        best, best_affected = None, None
+        for snap in self.snapshots:
+            if snap[2] != fidelity:
+                continue
+            affected = self.affected_classes(snap[0] != p)
+            if best is None or len(affected) < len(best_affected):
+                best, best_affected = snap, affected
+        if best is not None:
+            class_yfps[:] = best[1]
+            class_yfps[best_affected] = 0
+            known[:] = True
+            known[best_affected] = False
+        return class_yfps, known, best
+
+    # remember the yfp levels of all classes for p, and keep the snapshot
+    # that was used as base around as well
+    def store_snapshot(self, p, class_yfps, base, fidelity = 1):
+        if not self.incremental:
+            return
+        kept = [snap for snap in self.snapshots if snap is base] + [snap for snap in self.snapshots if snap is not base]
+        self.snapshots = [(np.array(p, dtype=float), class_yfps, fidelity)] + kept[:self.max_snapshots - 1]
+
+    # simulate all classes for a single p, reusing a snapshot where possible
+    # returns the yfp levels of all classes
+    def simulate_incremental(self, p, fidelity = 1):
+        p = np.asarray(p, dtype=float)
+        class_yfps, known, base = self.snapshot_base(p, fidelity)
+        missing = np.flatnonzero(~known)
+        class_yfps[missing] = self.simulate_classes(p, missing, fidelity)
+        self.classes_simulated += len(missing)
+        self.classes_reused += self.class_count - len(missing)
+        self.store_snapshot(p, class_yfps, base, fidelity)
+        return class_yfps
+
+    # remember how much each strain contributed to the badness
+    def update_strain_weights(self, typeids, badnesses):
+        unseen = self.strain_weight[typeids] == 0
+        self.strain_weight[typeids] = np.where(unseen, badnesses, 0.9 * self.strain_weight[typeids] + 0.1 * badnesses)
+
+    # evaluate many candidate parameter vectors in one call
+    # P: (N, n_params) array, one candidate per row
+    # returns an array with the N badness values
+    def get_badness_batch(self, P, method, fidelity = 1):
+        yfps = self.simulate_population(P, fidelity)
+        return np.sum(self.get_loss(yfps, self.measurements, method, self.log_measurements), axis=1)
+
+    # like get_badness_batch, but the badness of every strain separately
+    # returns a (N, strains) array, 0 for strains that aren't clonable
+    def get_strain_badness_batch(self, P, method, fidelity = 1):
+        yfps = self.simulate_population(P, fidelity)
+        losses = self.get_loss(yfps, self.measurements, method, self.log_measurements)
+        # the setups are ordered by strain, 4 for every clonable one
+        strain_badness = np.zeros((len(losses), self.strain_count))
+        strain_badness[:, np.flatnonzero(self.valids)] = losses.reshape(len(losses), -1, 4).sum(axis=2)
+        return strain_badness
+
+    # the badness and its gradient with respect to p, computed from the forward
+    # sensitivities of the simulation (always at full fidelity with the
+    # discrete model)
+    # returns the badness and an array with its n_params derivatives
+    def get_badness_grad(self, p, method, debug = 0):
+        padded = np.append(p, 0)
+        params = self.class_const + padded[self.class_src]
+        class_yfps, class_sens = simulate_batch_sensitivities(params)
+        yfps = class_yfps[self.setup_class]
+        badness = np.sum(self.get_loss(yfps, self.measurements, method, self.log_measurements))
+        # chain rule: loss -> yfp levels of each setup -> parameters of its class
+        loss_grad = self.get_loss_grad(yfps, self.measurements, method, self.log_measurements)
+        params_grad = np.zeros((self.class_count, 19))
+        np.add.at(params_grad, self.setup_class, np.einsum('mt,mtj->mj', loss_grad, class_sens[self.setup_class]))
+        # -> entries of p: every simulation parameter is a constant plus one entry of p
+        grad = np.bincount(self.class_src.ravel(), weights=params_grad.ravel(), minlength=self.n_params + 1)
+        if debug >= 1:
+            print("%f, gradient: %s" % (badness, str(grad[:self.n_params])))
+        return badness, grad[:self.n_params]
+
     # get_badness is the function we want to optimize
     # p is its list (array) of parameters to compute the badness for
-    def get_badness(self, p, method, debug):
+    # cutoff: stop as soon as the badness reaches this value and return the
+    # partial badness, which is then a lower bound of the real one. All loss
+    # terms are non-negative, so comparing the result to the cutoff is exact.
+    # Only used when the simulations are done one by one, batched ones are
+    # always complete (see one_by_one).
+    # fidelity: 1 for full accuracy, higher for coarser and faster simulations
+    def get_badness(self, p, method, debug, cutoff = None, fidelity = 1):
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(p, method, self.cache_context(fidelity))
+        if cached is not None:
+            strain_badness = cached[1]
+            telemetry.count('cache_hits')
+        elif cutoff is not None and debug < 2 and self.one_by_one(fidelity):
+            return self.get_badness_pruned(p, method, cutoff, fidelity)
+        else:
+            yfps = self.simulate_incremental(p, fidelity)[self.setup_class]
+            losses = self.get_loss(yfps, self.measurements, method, self.log_measurements)
+            strain_badness = np.bincount(self.setup_strain, weights=losses, minlength=self.strain_count)
+            valid = np.flatnonzero(self.valids)
+            self.update_strain_weights(valid, strain_badness[valid])
+            if self.cache is not None:
+                self.cache.put(p, method, self.cache_context(fidelity), np.sum(strain_badness), strain_badness)
+        telemetry.set('strain_badness', strain_badness)
+
         # this is the value that will accumulate the deviation from the measurements
         badness_total = 0.0
         badnesses = []
-        # for all 48x4 possible setups
         for typeid in range(self.strain_count):
-            badness = 0.0
-            # only simulate the cloneable arrangements
-            if self.valids[typeid] == True:
-                for iptgatc in range(4):
-                    # get the parameters for the simulation via teh ruleset
-                    params = self.apply_ruleset(p, typeid, iptgatc)
-                    # get the simualted yfp levels
-                    yfps = np.array(simulate(params))
-                    # get the actual measurements for comparison
-                    measurements = self.data[typeid][iptgatc]
-                    # comute the quadratic difference and add it to the badness
-                    #print(yfps)
-                    #print(measurements)
-                    if method == 0:
-                        badness += np.sum((yfps-measurements)**2)
-                    elif method == 1:
-                        yfps = np.maximum(yfps, np.add(np.zeros(4), 0.000001))
-                        badness += np.sum(np.abs(np.log10(yfps) - np.log10(measurements)))
-                    elif method == 2:
-                        badness += np.sum(abs(yfps-measurements))
-                    elif method == 3:
-                        yfps = np.maximum(yfps, np.add(np.zeros(4), 0.000001))
-                        badness += np.sum(np.exp(np.abs(np.log10(yfps) - np.log10(measurements))))
+            # only the cloneable arrangements were simulated, the others are 0
+            badness = strain_badness[typeid]
             badness_total += badness
             if debug >= 2:
                 print("%s: %f" % (self.types[typeid], badness))
@@ -155,19 +455,78 @@ class ParamEvaluator():
             return badness_total, badnesses
         return badness_total
 
+    # get_badness with a cutoff: simulate the strains that contributed most
+    # in the past first, one at a time, and stop once the cutoff is reached
+    def get_badness_pruned(self, p, method, cutoff, fidelity = 1):
+        p = np.asarray(p, dtype=float)
+        order = [typeid for typeid in np.argsort(-self.strain_weight, kind='stable') if self.valids[typeid]]
+        # yfp levels of the classes simulated (or known from a snapshot) so far
+        class_yfps, simulated, base = self.snapshot_base(p, fidelity)
+        strain_badness = np.zeros(self.strain_count)
+        badness_total = 0.0
+        start = 0
+        while start < len(order):
+            typeids = order[start:start + 1]
+            setups = self.strain_setups[typeids[0]]
+            classes = np.unique(self.setup_class[setups])
+            self.classes_reused += np.count_nonzero(simulated[classes])
+            classes = classes[~simulated[classes]]
+            class_yfps[classes] = self.simulate_classes(p, classes, fidelity)
+            simulated[classes] = True
+            self.classes_simulated += len(classes)
+
+            losses = self.get_loss(class_yfps[self.setup_class[setups]], self.measurements[setups], method,
+                                   self.log_measurements[setups])
+            badnesses = losses.reshape(len(typeids), -1).sum(axis=1)
+            self.update_strain_weights(typeids, badnesses)
+            strain_badness[typeids] = badnesses
+            self.strains_evaluated += len(typeids)
+            badness_total += np.sum(badnesses)
+            start += 1
+            if badness_total >= cutoff:
+                self.strains_skipped += len(order) - start
+                break
+        if np.all(simulated):
+            self.store_snapshot(p, class_yfps, base, fidelity)
+        telemetry.count('strains_skipped', len(order) - start)
+        if start == len(order):
+            telemetry.set('strain_badness', strain_badness)
+            if self.cache is not None:
+                self.cache.put(p, method, self.cache_context(fidelity), np.sum(strain_badness), strain_badness)
+        return badness_total
+
     def get_type(self, typeid):
         return self.types[typeid]
 
 
     def plot_measurement(self, typeid, iptgatc):
+        # only imported when needed, so worker processes start fast
+        import matplotlib.pyplot as plt
         if self.valids[typeid]:
             plt.plot(self.plotx, self.data[typeid][iptgatc], 'orange', label='YFP measured', linewidth=2.0)
     
 
-    def print_mirror_pairs():
+    # print how many simulations the equivalence classes of setups save
+    def print_dedup_stats(self):
+        print("%d setups in %d classes, %d simulations saved per candidate" %
+              (len(self.setups), self.class_count, self.sims_saved))
+
+    # print how many strain simulations evaluations with a cutoff skipped
+    def print_prune_stats(self):
+        total = self.strains_evaluated + self.strains_skipped
+        print("%d of %d strains skipped by the cutoff (%.1f%%)" %
+              (self.strains_skipped, total, 100.0 * self.strains_skipped / max(total, 1)))
+
+    # print how many class simulations the snapshots saved
+    def print_incremental_stats(self):
+        total = self.classes_simulated + self.classes_reused
+        print("%d of %d class simulations reused from snapshots (%.1f%%)" %
+              (self.classes_reused, total, 100.0 * self.classes_reused / max(total, 1)))
+
+    def print_mirror_pairs(self):
         # I haven't really tested this lately, it worked at some point.
         used = set()
-        for i in range(48):
+        for i in range(self.strain_count):
             if i in used:
                 continue
             tp = self.types[i]
@@ -181,7 +540,7 @@ class ParamEvaluator():
             chars[3] = tp[5]
             chars[4] = tp[4]
             inverse = ''.join(chars)
-            for j in range(48):
+            for j in range(self.strain_count):
                 if self.types[j] == inverse:
                     print(self.types[i], self.data[i], self.types[j], self.data[j])
                     used.add(j)
@@ -193,43 +552,296 @@ class ParamEvaluator():
 # maxs is the array of maximum values each parameter can take
 # method: use square differences, log ratios or absolute differences
 # debug: print intermediate values
-def optimize(func, init, mins, maxs, method, debug):
+# prune: pass the current badness as cutoff to func, so it can stop
+# evaluating candidates that can't be better
+# block: if set, only vary this many randomly chosen parameters at a time,
+# so that an incremental evaluator only has to re-simulate what they affect
+# fidelity: list of (temp, level) pairs with decreasing temp. While the
+# temperature is above temp, candidates are evaluated at that fidelity level
+# (passed on to func), otherwise at full fidelity 1. Whenever the level
+# changes, the current values are re-evaluated at the new level, so the
+# final badness is always a full fidelity one.
+# surrogate: a Surrogate that decides which candidates are worth evaluating
+# checkpoint: file the state (values, badness, temperature, random state,
+# number of evaluations) is saved to every checkpoint_interval seconds and on
+# ctrl-c. If it exists, the run continues from there, exactly as if it hadn't
+# been interrupted. It is removed when the run finishes.
+def optimize(func, init, mins, maxs, method, debug, prune = False, block = None, fidelity = None,
+             surrogate = None, checkpoint = None, checkpoint_interval = 60):
     # number of parameters
     n = len(init)
     # the range of each of the 
     ranges = maxs - mins #np.array([maxs[i] - mins[i] for i in range(n)])
-    # vals will be the current set of parameter values
-    vals = init
-    # temp is the heat/temperature, determining how far we may vary
-    # when picking the next set of parameters to try
-    temp = 0.4
-    # initial badness for the initial parameters
-    badness = func(vals, method, debug)
-    print("%f @ temp %f: %s" % (badness, temp, str(vals)))
+    # extra arguments for func
+    kwargs = {}
+    # the measurement file of func's evaluator, if it has one, and the fidelity
+    # schedule have to match for a checkpoint to be resumed
+    dataset = getattr(getattr(func, '__self__', None), 'dataset_hash', None)
+    state = load_checkpoint(checkpoint, method, mins, maxs, dataset, fidelity) if checkpoint is not None else None
+    if state is not None:
+        vals = state['vals']
+        badness = state['badness']
+        temp = state['temp']
+        level = state['level']
+        evaluations = state['evaluations']
+        np.random.set_state(state['random'])
+        if level != 1:
+            kwargs['fidelity'] = level
+        if surrogate is not None and state['surrogate'] is not None:
+            surrogate.__dict__.update(state['surrogate'].__dict__)
+        print("%f @ temp %f: resumed after %d evaluations: %s" % (badness, temp, evaluations, str(vals)))
+    else:
+        # vals will be the current set of parameter values
+        vals = init
+        # temp is the heat/temperature, determining how far we may vary
+        # when picking the next set of parameters to try
+        temp = 0.4
+        # initial badness for the initial parameters
+        badness = func(vals, method, debug)
+        evaluations = 1
+        print("%f @ temp %f: %s" % (badness, temp, str(vals)))
+        level = 1
+        if surrogate is not None:
+            surrogate.add(vals, badness)
     badness_new = 0.0
-    while temp > 0.0005:
-        #print("Temp: %f Badness: %f" % (temp, badness_new))
-        # get the new array of parameters by sampling a normal
-        # distribution around the old values with standard deviation
-        # proportional to temperature and range of the parameter
-        vals_new = np.random.normal(vals, temp*ranges, n)
-        # make sure the new values don't exceed the range
-        vals_new = np.maximum(vals_new, mins)
-        vals_new = np.minimum(vals_new, maxs)
-        # compute the new badness
-        badness_new = func(vals_new, method, debug)
-        # pick the new set of values if they are better
-        if badness_new < badness:
-            badness = badness_new
-            vals = vals_new
-            if debug >= 1:
-                print("%f @ temp %f: %s" % (badness_new, temp, str(vals_new)))
-        # reduce the temperature
-        temp -= 0.002
+    # with a checkpoint, ctrl-c stops at the start of the next step, so the
+    # checkpoint always holds the state in between two steps
+    interrupted = []
+    previous_handler = None
+    if checkpoint is not None:
+        try:
+            previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: interrupted.append(signum))
+        except ValueError:
+            # not the main thread, ctrl-c can't be caught here
+            pass
+    saved = time.time()
+    # telemetry is emitted every window steps: the acceptance rate in the
+    # window and the share of each strain in the badness of the current values
+    window = 10
+    proposed = accepted = skipped = 0
+    window_start = time.time()
+    window_evaluations = evaluations
+    strains = telemetry.get('strain_badness')
+    previous_share = None
+    telemetry.emit('start', temp = temp, badness = float(badness), evaluations = evaluations)
+    try:
+        while temp > 0.0005:
+            if checkpoint is not None and (interrupted or time.time() - saved >= checkpoint_interval):
+                save_checkpoint(checkpoint, method, mins, maxs, vals, badness, temp, level, evaluations, surrogate,
+                                dataset, fidelity)
+                saved = time.time()
+                if interrupted:
+                    print("interrupted, checkpoint written to %s" % checkpoint)
+                    raise KeyboardInterrupt
+            if fidelity is not None:
+                level_new = next((l for t, l in fidelity if temp > t), 1)
+                if level_new != level:
+                    level = level_new
+                    kwargs['fidelity'] = level
+                    badness = func(vals, method, debug, **kwargs)
+                    evaluations += 1
+                    strains = telemetry.get('strain_badness')
+                    telemetry.emit('fidelity', temp = temp, badness = float(badness), level = level)
+                    if surrogate is not None:
+                        # the badnesses of different levels don't mix
+                        surrogate.reset()
+                        surrogate.add(vals, badness)
+                    if debug >= 1:
+                        print("%f @ temp %f: fidelity %d" % (badness, temp, level))
+            #print("Temp: %f Badness: %f" % (temp, badness_new))
+            # get the new array of parameters by sampling a normal
+            # distribution around the old values with standard deviation
+            # proportional to temperature and range of the parameter
+            vals_new = np.random.normal(vals, temp*ranges, n)
+            if block is not None:
+                # keep all but block of the (non-fixed) parameters
+                free = np.flatnonzero(ranges > 0)
+                keep = np.ones(n, dtype=bool)
+                keep[np.random.choice(free, min(block, len(free)), replace=False)] = False
+                vals_new[keep] = vals[keep]
+            # make sure the new values don't exceed the range
+            vals_new = np.maximum(vals_new, mins)
+            vals_new = np.minimum(vals_new, maxs)
+            # ask the surrogate whether the candidate is worth evaluating
+            decision = 'forward'
+            if surrogate is not None:
+                surrogate.set_width(temp)
+                decision = surrogate.screen(vals_new, badness)
+            if decision == 'skip':
+                badness_new = badness
+                skipped += 1
+            # compute the new badness
+            elif prune:
+                badness_new = func(vals_new, method, debug, cutoff = badness, **kwargs)
+            else:
+                badness_new = func(vals_new, method, debug, **kwargs)
+            if decision != 'skip':
+                evaluations += 1
+            # a pruned badness is only a lower bound, but still a useful one
+            if surrogate is not None and decision != 'skip':
+                surrogate.record(vals_new, badness_new, badness, decision)
+            # pick the new set of values if they are better
+            if badness_new < badness:
+                badness = badness_new
+                vals = vals_new
+                accepted += 1
+                strains = telemetry.get('strain_badness')
+                if debug >= 1:
+                    print("%f @ temp %f: %s" % (badness_new, temp, str(vals_new)))
+            # reduce the temperature
+            temp -= 0.002
+            proposed += 1
+            if telemetry.enabled and proposed == window:
+                share = None
+                drift = None
+                if strains is not None:
+                    share = strains / max(np.sum(strains), 1e-300)
+                    if previous_share is not None:
+                        # total variation distance to the share a window ago
+                        drift = 0.5 * float(np.sum(np.abs(share - previous_share)))
+                    previous_share = share
+                elapsed = max(time.time() - window_start, 1e-9)
+                telemetry.emit('window', temp = temp, badness = float(badness), evaluations = evaluations,
+                               rate = (evaluations - window_evaluations) / elapsed,
+                               acceptance = accepted / float(proposed), skipped = skipped, level = level,
+                               strain_share = None if share is None else share.tolist(), strain_drift = drift)
+                proposed = accepted = skipped = 0
+                window_start = time.time()
+                window_evaluations = evaluations
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
+    if level != 1:
+        # verify the result at full fidelity
+        badness = func(vals, method, debug)
+        evaluations += 1
+    if debug >= 1:
+        print("%d evaluations" % evaluations)
+    telemetry.emit('end', badness = float(badness), evaluations = evaluations)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        # the run is finished, a new one with the same file starts over
+        os.remove(checkpoint)
     return badness, vals
+
+
+# write the state of optimize() to the file path, replacing it atomically
+# dataset: the dataset_hash of the evaluator (None if unknown)
+# fidelity: the fidelity schedule of optimize()
+def save_checkpoint(path, method, mins, maxs, vals, badness, temp, level, evaluations, surrogate, dataset = None,
+                    fidelity = None):
+    state = {'method': method, 'mins': np.array(mins), 'maxs': np.array(maxs),
+             'vals': np.array(vals), 'badness': badness, 'temp': temp, 'level': level,
+             'evaluations': evaluations, 'random': np.random.get_state(), 'surrogate': surrogate,
+             'dataset': dataset, 'fidelity': fidelity_schedule(fidelity)}
+    with open(path + '.tmp', 'wb') as checkpoint_file:
+        pickle.dump(state, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+# the fidelity schedule as a list of (temp, level) tuples, or None
+def fidelity_schedule(fidelity):
+    return None if fidelity is None else [(float(t), int(l)) for t, l in fidelity]
+
+
+# the state saved by save_checkpoint, or None if there is no checkpoint
+# raises a ValueError if it was saved by a run with a different method,
+# ranges, measurement file or fidelity schedule
+def load_checkpoint(path, method, mins, maxs, dataset = None, fidelity = None):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as checkpoint_file:
+        state = pickle.load(checkpoint_file)
+    if state['method'] != method or not np.array_equal(state['mins'], mins) or not np.array_equal(state['maxs'], maxs):
+        raise ValueError("checkpoint %s belongs to a different run" % path)
+    if state.get('dataset') != dataset:
+        raise ValueError("checkpoint %s was computed on a different measurement file" % path)
+    if state.get('fidelity') != fidelity_schedule(fidelity):
+        raise ValueError("checkpoint %s belongs to a run with a different fidelity schedule" % path)
+    return state
     
 
 
+# two-loop recursion of L-BFGS: apply the inverse Hessian approximation
+# given by the pairs of steps s and gradient changes y to g
+def lbfgs_direction(g, s_list, y_list):
+    q = g.copy()
+    alphas = []
+    for s, y in reversed(list(zip(s_list, y_list))):
+        alpha = s.dot(q) / y.dot(s)
+        q -= alpha * y
+        alphas.append(alpha)
+    if s_list:
+        q *= s_list[-1].dot(y_list[-1]) / y_list[-1].dot(y_list[-1])
+    for (s, y), alpha in zip(zip(s_list, y_list), reversed(alphas)):
+        beta = y.dot(q) / y.dot(s)
+        q += s * (alpha - beta)
+    return -q
+
+
+# local refinement with a bounded quasi-Newton method (projected L-BFGS)
+# func(p, method) returns the badness and its gradient, e.g. get_badness_grad
+# init, mins, maxs, method, debug: as for optimize()
+# max_iter: maximum number of iterations
+# memory: number of step/gradient pairs kept by L-BFGS
+# tol: stop when the badness improves by less than this fraction
+# The parameters are scaled to [0, 1] by their ranges, and parameters with
+# an empty range stay fixed.
+def optimize_gradient(func, init, mins, maxs, method, debug, max_iter = 100, memory = 10, tol = 1e-6):
+    ranges = maxs - mins
+    free = ranges > 0
+    scale = np.where(free, ranges, 1)
+    # z are the scaled parameters
+    z = np.clip((init - mins) / scale, 0, 1)
+    badness, grad = func(mins + z * scale, method)
+    g = grad * scale * free
+    evaluations = 1
+    print("%f @ iteration 0: %s" % (badness, str(mins + z * scale)))
+    s_list, y_list = [], []
+    for iteration in range(1, max_iter + 1):
+        # parameters at a bound that the gradient pushes outwards stay there
+        active = ((z <= 0) & (g > 0)) | ((z >= 1) & (g < 0)) | ~free
+        d = lbfgs_direction(g * ~active, s_list, y_list) * ~active
+        if d.dot(g) >= 0:
+            # not a descent direction, start over with steepest descent
+            s_list, y_list = [], []
+            d = -g * ~active
+        if not s_list:
+            # without curvature information, take a step of at most 10% of the ranges
+            d *= 0.1 / max(np.max(np.abs(d)), 1e-300)
+        # backtracking line search with the armijo condition on the projected step
+        step = 1.0
+        accepted = False
+        for _ in range(30):
+            z_new = np.clip(z + step * d, 0, 1)
+            badness_new, grad_new = func(mins + z_new * scale, method)
+            evaluations += 1
+            if badness_new <= badness + 1e-4 * g.dot(z_new - z):
+                accepted = True
+                break
+            step *= 0.5
+        if not accepted:
+            break
+        g_new = grad_new * scale * free
+        s, y = z_new - z, g_new - g
+        if s.dot(y) > 1e-12:
+            s_list.append(s)
+            y_list.append(y)
+            if len(s_list) > memory:
+                s_list.pop(0)
+                y_list.pop(0)
+        improvement = badness - badness_new
+        z, g, badness = z_new, g_new, badness_new
+        if debug >= 1:
+            print("%f @ iteration %d: %s" % (badness, iteration, str(mins + z * scale)))
+        if improvement <= tol * abs(badness):
+            break
+    if debug >= 1:
+        print("%d evaluations" % evaluations)
+    return badness, mins + z * scale
+
+
 if __name__ == "__main__":
               # init, min, max
     params = [(  0.02,  1e-3,   0.2), # 0 Protein degradation:
@@ -260,7 +872,63 @@ if __name__ == "__main__":
     measurement_file = 'absolute.csv';
     #measurement_file = 'expected2.csv';
     #measurement_file = 'wt.csv';
+    # fit several measurement files at once, sharing the simulations: list of
+    # (filename, weight), or None to fit measurement_file alone
+    joint_files = None
+    #joint_files = [('absolute.csv', 1.0), ('expected2.csv', 1.0), ('wt.csv', 1.0)]
     run_optization = True
+    optimizer = 'greedy' # single chain optimize()
+    #optimizer = 'tempering' # parallel tempering over several processes
+    #optimizer = 'gradient' # local refinement with projected L-BFGS
+    #optimizer = 'cmaes' # CMA-ES on batched evaluations
+    #optimizer = 'de' # differential evolution on batched evaluations
+    #optimizer = 'async' # optimize() with several candidates evaluated at once
+    # replay log of the 'async' optimizer, see annealing.replay_async
+    async_log = 'annealing.jsonl'
+    # stop evaluating candidates once they are worse than the current best.
+    # Only has an effect with ParamEvaluator(batched = False), which checks
+    # the cutoff after every strain; batched evaluations are always complete
+    prune = False
+    # number of parameters varied per step (None: all of them). With few,
+    # get_badness only re-simulates the setups these parameters affect
+    block = None
+    # cheaper, coarser simulations while the temperature is high, e.g. 8
+    # minute steps above temp 0.1, 4 minute steps above 0.02, full fidelity
+    # below (a step of n minutes costs about as much as two one-minute steps)
+    fidelity = None
+    #fidelity = [(0.1, 8), (0.02, 4)]
+    # pre-screen candidates with a surrogate model of the badness
+    use_surrogate = False
+    # the results of all runs are appended to this file, and without
+    # run_optization the best stored result for measurement_file and method
+    # is plotted (the params above are only used if there is none)
+    results_file = 'results.jsonl'
+    # save the state of optimize() to this file, so an interrupted run can be
+    # resumed by starting it again
+    checkpoint_file = None
+    #checkpoint_file = 'optimize.checkpoint'
+    # write timings, counters and the progress of optimize() to this file
+    # (json lines, see telemetry.py)
+    telemetry_file = None
+    #telemetry_file = 'telemetry.jsonl'
+    # keep all evaluations in a file, so later runs don't repeat them
+    cache_file = None
+    #cache_file = 'evaluations.sqlite'
+    # evaluate on workers, possibly on other hosts, started with
+    # python distributed.py host:port measurement_file
+    broker_port = None
+    #broker_port = 5555
+    # 95% intervals of the parameters from this many bootstrap resamples of
+    # the strains of measurement_file, fitted starting from the result
+    bootstrap_resamples = None
+    #bootstrap_resamples = 100
+    # map the badness over some parameters instead of optimizing, see sweep.py
+    sweep_dir = None
+    #sweep_dir = 'sweep'
+    sweep_params = [0, 1, 7, 12]
+    sweep_design = {'kind': 'sobol', 'n': 2**14}
+    #sweep_design = {'kind': 'lhs', 'n': 10000, 'seed': 0}
+    #sweep_design = {'kind': 'grid', 'levels': 10}
     #method = 0 # quad diff
     #method = 1 # ratio-log
     #method = 2 # linear diff
@@ -447,44 +1115,88 @@ if __name__ == "__main__":
     mins = np.array(transpose[1])
     maxs = np.array(transpose[2])
 
-    pe = ParamEvaluator(measurement_file)
+    if telemetry_file is not None:
+        telemetry.enable(telemetry_file)
+    cache = EvalCache(cache_file) if cache_file is not None else None
+    pe = ParamEvaluator(measurement_file, cache = cache)
+    pe.print_dedup_stats()
+    # the evaluator that is optimized
+    fit = pe
+    fit_label = measurement_file
+    if joint_files is not None:
+        # multifit imports this module, so it can't be imported at the top
+        from multifit import MultiEvaluator
+        fit = MultiEvaluator(joint_files)
+        fit.print_dedup_stats()
+        fit_label = ", ".join("%s (%g)" % pair for pair in joint_files)
+    elif broker_port is not None:
+        fit = Broker(port = broker_port, dataset = pe.dataset_hash)
+        print("waiting for workers on port %d" % fit.port)
+    fit_hash = pe.dataset_hash
+    if joint_files is not None:
+        fit_hash = ",".join(evaluator.dataset_hash for evaluator in fit.evaluators)
+    store = ResultsStore(results_file)
+
+    if sweep_dir is not None:
+        run_sweep(pe, sweep_dir, sweep_design, sweep_params, init, mins, maxs, method)
+        print("First order sensitivity indices of log10 badness:")
+        print_sensitivity(sensitivity_indices(sweep_dir))
 
     if run_optization:
-        badness, vals = optimize(pe.get_badness, init, mins, maxs, method, debug = 1)
+        if optimizer in ('tempering', 'async') and isinstance(fit, Broker):
+            raise ValueError("the %s optimizer runs its own processes and can't use the broker" % optimizer)
+        if optimizer == 'tempering':
+            badness, vals = optimize_tempering(fit.get_badness, init, mins, maxs, method, debug = 1)
+        elif optimizer == 'async':
+            badness, vals = optimize_async(fit.get_badness, init, mins, maxs, method, debug = 1, prune = prune,
+                                           log = async_log)
+        elif optimizer == 'gradient':
+            if fit is not pe:
+                raise ValueError("the gradient optimizer only supports a single measurement file")
+            badness, vals = optimize_gradient(pe.get_badness_grad, init, mins, maxs, method, debug = 1)
+        elif optimizer == 'cmaes':
+            badness, vals = optimize_cmaes(fit.get_badness_batch, init, mins, maxs, method, debug = 1)
+        elif optimizer == 'de':
+            badness, vals = optimize_de(fit.get_badness_batch, init, mins, maxs, method, debug = 1)
+        else:
+            surrogate = Surrogate(mins, maxs) if use_surrogate else None
+            badness, vals = optimize(fit.get_badness, init, mins, maxs, method, debug = 1, prune = prune, block = block,
+                                     fidelity = fidelity, surrogate = surrogate, checkpoint = checkpoint_file)
+            if surrogate is not None:
+                surrogate.print_stats()
+            if fit is pe:
+                if prune:
+                    pe.print_prune_stats()
+                pe.print_incremental_stats()
+            if cache is not None:
+                cache.print_stats()
+        if isinstance(fit, Broker):
+            fit.print_stats()
+            fit.close()
 
+        store.add(fit_label, fit_hash, method, optimizer, badness, vals, mins, maxs)
         print("Best badness: %f" % badness)
         print("Parameters: %s" % str(vals))
         # printing optimized values in python style to include new parameters in the code 
         for i in range(len(init)):
             if i == 0:
-                print("params_opt = [(%f, %f, %f),  # badness: %f adjusted to: %s" % (vals[i], mins[i], maxs[i], badness, measurement_file))
+                print("params_opt = [(%f, %f, %f),  # badness: %f adjusted to: %s" % (vals[i], mins[i], maxs[i], badness, fit_label))
             elif (i != 0) and (i < (len(init) - 1)):
                 print("\t\t\t(%f, %f, %f), #%d" % (vals[i], mins[i], maxs[i], i))
             else:
                 print("\t\t\t(%f, %f, %f)]" % (vals[i], mins[i], maxs[i]))
 
         init = vals
+    else:
+        best = store.best(pe.dataset_hash, method)
+        if best is not None:
+            print("plotting the best stored result for %s: %f (%s, %s)" %
+                  (measurement_file, best['badness'], best['optimizer'], best['time']))
+            init = np.array(best['params'])
+
+    if bootstrap_resamples is not None:
+        bootstrap_params, _, converged = bootstrap(pe, init, mins, maxs, method, resamples = bootstrap_resamples)
+        print_intervals(bootstrap_params, init, converged = converged, used = pe.class_deps.any(axis=0))
 
     # plot graphs for the simulation
-    titles = ['None', 'aTc', 'IPTG', 'Both']
-    bd, bdlist = pe.get_badness(init, method, debug = 3)
-    for typeid in range(48):
-        plt.figure(figsize=(12.0, 8.0))
-        plt.suptitle("%s, badness: %.2f" % (pe.get_type(typeid), bdlist[typeid]), fontsize=18)
-        for iptgatc in range(4):
-            pos = 221 + iptgatc
-            plt.subplot(pos)
-            applied_params = pe.apply_ruleset(init, typeid, iptgatc)
-            simulate(applied_params, plot = True)
-            pe.plot_measurement(typeid, iptgatc)
-            plt.title(titles[iptgatc])
-            plt.yscale('log')
-            plt.ylim([1, 100000])
-            plt.ylabel('Protein Amount [AU]')
-            plt.xlabel('time [min]')
-            plt.legend(loc='lower right', shadow=True, fontsize='large')
-        plt.get_current_fig_manager().resize(1000, 800)
-        plt.tight_layout()
-        #plt.show()
-        plt.savefig("figures/%s.png" % pe.get_type(typeid))
-        plt.close()
+    render_report(pe, init, method)
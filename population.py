@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Population based optimizers. Instead of func(vals, method, debug) they use
+# func(P, method), which evaluates a whole (N, n_params) population at once
+# and returns the N badness values (e.g. ParamEvaluator.get_badness_batch),
+# so every generation is a single vectorized call.
+#
+# Both work on the parameters scaled to [0, 1] by their ranges and clip
+# candidates to the box. Parameters with an empty range stay fixed.
+
+
+# scaling between the parameters and the unit box of the free ones
+class UnitBox():
+
+    def __init__(self, init, mins, maxs):
+        self.init = np.array(init, dtype=float)
+        self.mins = np.asarray(mins, dtype=float)
+        self.ranges = np.asarray(maxs, dtype=float) - self.mins
+        self.free = np.flatnonzero(self.ranges > 0)
+        self.n = len(self.free)
+
+    # unit box coordinates (N, n) -> parameters (N, n_params)
+    def to_params(self, Z):
+        P = np.tile(self.init, (len(Z), 1))
+        P[:, self.free] = self.mins[self.free] + np.clip(Z, 0, 1) * self.ranges[self.free]
+        return P
+
+    def to_unit(self, p):
+        return np.clip((np.asarray(p)[self.free] - self.mins[self.free]) / self.ranges[self.free], 0, 1)
+
+
+# covariance matrix adaptation evolution strategy
+# func, init, mins, maxs, method, debug: as described above and for optimize()
+# popsize: candidates per generation (default 4 + 3 ln n)
+# sigma: initial step size relative to the parameter ranges
+# max_evals: stop after this many evaluations
+# tol: stop when the step size falls below this
+# seed: seed of the random numbers
+# returns the best badness and parameters found
+def optimize_cmaes(func, init, mins, maxs, method, debug, popsize = None, sigma = 0.3, max_evals = 5000,
+                   tol = 1e-8, seed = 0):
+    rng = np.random.RandomState(seed)
+    box = UnitBox(init, mins, maxs)
+    n = box.n
+    lam = popsize if popsize is not None else 4 + int(3 * np.log(n))
+    mu = lam // 2
+    # recombination weights of the mu best candidates
+    weights = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+    weights /= np.sum(weights)
+    mueff = 1 / np.sum(weights**2)
+    # learning rates of the evolution paths and the covariance matrix
+    cc = (4 + mueff / n) / (n + 4 + 2 * mueff / n)
+    cs = (mueff + 2) / (n + mueff + 5)
+    c1 = 2 / ((n + 1.3)**2 + mueff)
+    cmu = min(1 - c1, 2 * (mueff - 2 + 1 / mueff) / ((n + 2)**2 + mueff))
+    damps = 1 + 2 * max(0, np.sqrt((mueff - 1) / (n + 1)) - 1) + cs
+    # expected length of a standard normal vector
+    chiN = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n**2))
+
+    mean = box.to_unit(init)
+    C = np.eye(n)
+    pc = np.zeros(n)
+    ps = np.zeros(n)
+
+    best_badness = func(box.to_params(mean[None]), method)[0]
+    best_vals = box.to_params(mean[None])[0]
+    print("%f @ sigma %f: %s" % (best_badness, sigma, str(best_vals)))
+    evals = 1
+    generation = 0
+    while evals + lam <= max_evals and sigma > tol:
+        # C = B D^2 B^T
+        D2, B = np.linalg.eigh(C)
+        D = np.sqrt(np.maximum(D2, 1e-30))
+        # sample and repair the candidates by clipping them to the box
+        Z = mean + sigma * rng.standard_normal((lam, n)).dot((B * D).T)
+        Z = np.clip(Z, 0, 1)
+        badnesses = func(box.to_params(Z), method)
+        evals += lam
+        generation += 1
+        order = np.argsort(badnesses)
+        if badnesses[order[0]] < best_badness:
+            best_badness = badnesses[order[0]]
+            best_vals = box.to_params(Z[order[:1]])[0]
+            if debug >= 1:
+                print("%f @ sigma %f (generation %d): %s" % (best_badness, sigma, generation, str(best_vals)))
+
+        old_mean = mean
+        selected = (Z[order[:mu]] - old_mean) / sigma
+        mean = old_mean + sigma * weights.dot(selected)
+        y = weights.dot(selected)
+        # evolution paths
+        C_invsqrt = (B / D).dot(B.T)
+        ps = (1 - cs) * ps + np.sqrt(cs * (2 - cs) * mueff) * C_invsqrt.dot(y)
+        hsig = np.linalg.norm(ps) / np.sqrt(1 - (1 - cs)**(2 * generation)) / chiN < 1.4 + 2 / (n + 1)
+        pc = (1 - cc) * pc + hsig * np.sqrt(cc * (2 - cc) * mueff) * y
+        # rank one and rank mu update of the covariance matrix
+        C = ((1 - c1 - cmu) * C
+             + c1 * (np.outer(pc, pc) + (1 - hsig) * cc * (2 - cc) * C)
+             + cmu * (selected.T * weights).dot(selected))
+        C = (C + C.T) / 2
+        sigma *= np.exp((cs / damps) * (np.linalg.norm(ps) / chiN - 1))
+        if debug >= 2:
+            print("generation %d: best %f, sigma %f" % (generation, badnesses[order[0]], sigma))
+    if debug >= 1:
+        print("%d evaluations in %d generations" % (evals, generation))
+    return best_badness, best_vals
+
+
+# differential evolution (rand/1/bin)
+# func, init, mins, maxs, method, debug: as described above and for optimize()
+# popsize: number of candidates (the first one is init, the others uniform)
+# weight: differential weight F
+# crossover: crossover probability CR
+# max_evals: stop after this many evaluations
+# seed: seed of the random numbers
+# returns the best badness and parameters found
+def optimize_de(func, init, mins, maxs, method, debug, popsize = 40, weight = 0.7, crossover = 0.9,
+                max_evals = 5000, seed = 0):
+    rng = np.random.RandomState(seed)
+    box = UnitBox(init, mins, maxs)
+    n = box.n
+    Z = rng.uniform(0, 1, (popsize, n))
+    Z[0] = box.to_unit(init)
+    badnesses = func(box.to_params(Z), method)
+    evals = popsize
+    best = np.argmin(badnesses)
+    print("%f @ generation 0: %s" % (badnesses[best], str(box.to_params(Z[best:best+1])[0])))
+    generation = 0
+    while evals + popsize <= max_evals:
+        # three distinct other members for every member
+        others = np.array([rng.choice(np.delete(np.arange(popsize), i), 3, replace=False) for i in range(popsize)])
+        mutants = Z[others[:, 0]] + weight * (Z[others[:, 1]] - Z[others[:, 2]])
+        cross = rng.uniform(size=(popsize, n)) < crossover
+        # at least one parameter always comes from the mutant
+        cross[np.arange(popsize), rng.randint(n, size=popsize)] = True
+        trials = np.clip(np.where(cross, mutants, Z), 0, 1)
+        trial_badnesses = func(box.to_params(trials), method)
+        evals += popsize
+        generation += 1
+        best_badness = badnesses[best]
+        better = trial_badnesses <= badnesses
+        Z[better] = trials[better]
+        badnesses[better] = trial_badnesses[better]
+        # members only ever get better, so the best member is the best ever
+        best = np.argmin(badnesses)
+        if debug >= 1 and badnesses[best] < best_badness:
+            print("%f @ generation %d: %s" % (badnesses[best], generation, str(box.to_params(Z[best:best+1])[0])))
+        if debug >= 2:
+            print("generation %d: best %f, mean %f" % (generation, badnesses[best], np.mean(badnesses)))
+    if debug >= 1:
+        print("%d evaluations in %d generations" % (evals, generation))
+    return badnesses[best], box.to_params(Z[best:best+1])[0]
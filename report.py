@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import multiprocessing
+import os
+from simulate import simulate_batch, trajectory_steps
+
+# Figures of the simulated and measured levels of every strain.
+#
+# The full trajectories of all strains and inducer combinations are simulated
+# once, together, into a (strains, 4, trajectory_steps, 4) array: identical
+# simulation parameters (e.g. from strains of the same type) are simulated
+# only once. The figures are then rendered by a pool of processes, one figure
+# per strain, directly on matplotlib's Agg canvas, so no display or pyplot
+# state is involved.
+
+titles = ['None', 'aTc', 'IPTG', 'Both']
+
+
+# simulate all strains with parameters p
+# returns a (strains, 4, trajectory_steps, 4) array with the levels of LacI,
+# TetR, lambdacI and YFP after every minute, for every inducer combination
+def compute_trajectories(pe, p):
+    params = np.array([pe.apply_ruleset(p, typeid, iptgatc)
+                       for typeid in range(pe.strain_count) for iptgatc in range(4)])
+    unique, inverse = np.unique(params, axis=0, return_inverse=True)
+    unique_trajectories = np.zeros((len(unique), trajectory_steps, 4))
+    simulate_batch(unique, trajectories = unique_trajectories)
+    trajectories = np.zeros((pe.strain_count, 4, trajectory_steps, 4))
+    trajectories.reshape(-1, trajectory_steps, 4)[:] = unique_trajectories[inverse.reshape(-1)]
+    return trajectories
+
+
+# render the figure of one strain
+# job: (filename, title, trajectories (4, trajectory_steps, 4), measured
+# (4, 4) yfp levels or None, times of the measurements in minutes)
+def render_strain(job):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    filename, title, trajectories, measured, plotx = job
+    figure = Figure(figsize=(12.0, 8.0))
+    FigureCanvasAgg(figure)
+    figure.suptitle(title, fontsize=18)
+    x = np.arange(trajectory_steps)
+    for iptgatc in range(4):
+        axes = figure.add_subplot(221 + iptgatc)
+        axes.plot(x, trajectories[iptgatc, :, 0], 'r', label='LacI')
+        axes.plot(x, trajectories[iptgatc, :, 1], 'b', label='TetR')
+        axes.plot(x, trajectories[iptgatc, :, 2], 'g', label='cI')
+        axes.plot(x, trajectories[iptgatc, :, 3], 'darkgoldenrod', label='YFP', linewidth=3.0)
+        if measured is not None:
+            axes.plot(plotx, measured[iptgatc], 'orange', label='YFP measured', linewidth=2.0)
+        axes.set_title(titles[iptgatc])
+        axes.set_yscale('log')
+        axes.set_ylim([1, 100000])
+        axes.set_ylabel('Protein Amount [AU]')
+        axes.set_xlabel('time [min]')
+        axes.legend(loc='lower right', shadow=True, fontsize='large')
+    figure.tight_layout()
+    figure.savefig(filename)
+    return filename
+
+
+# render the figures of all strains of pe with parameters p to directory
+# method: the badness method shown in the titles
+# processes: number of rendering processes (default: all cores)
+# returns the list of files written
+def render_report(pe, p, method, directory = 'figures', processes = None):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    trajectories = compute_trajectories(pe, p)
+    strain_badness = pe.get_strain_badness_batch(np.asarray(p, dtype=float)[None], method)[0]
+    # files are named by type, and by type and strain if a type occurs twice
+    names = [pe.get_type(typeid) if pe.types.count(pe.get_type(typeid)) == 1 else
+             "%s_%d" % (pe.get_type(typeid), typeid) for typeid in range(pe.strain_count)]
+    jobs = [(os.path.join(directory, "%s.png" % names[typeid]),
+             "%s, badness: %.2f" % (pe.get_type(typeid), strain_badness[typeid]),
+             trajectories[typeid],
+             np.array(pe.data[typeid]) if pe.valids[typeid] else None,
+             pe.plotx)
+            for typeid in range(pe.strain_count)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(render_strain, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [render_strain(job) for job in jobs]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+# Store of optimization results.
+#
+# Every finished run is appended as one json object per line to a file:
+#   time:         when the run finished
+#   dataset:      description of the measurement file(s)
+#   dataset_hash: sha1 of the measurement file(s), see ParamEvaluator
+#   method:       the badness method
+#   optimizer:    name of the optimizer
+#   badness:      best badness found
+#   params, mins, maxs: the best parameters and their ranges
+# Lines are appended with a single write, so several runs can share a file.
+class ResultsStore():
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, dataset, dataset_hash, method, optimizer, badness, params, mins, maxs):
+        record = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'dataset': dataset,
+                  'dataset_hash': dataset_hash,
+                  'method': int(method),
+                  'optimizer': optimizer,
+                  'badness': float(badness),
+                  'params': [float(x) for x in params],
+                  'mins': [float(x) for x in mins],
+                  'maxs': [float(x) for x in maxs]}
+        with open(self.path, 'a') as store_file:
+            store_file.write(json.dumps(record) + '\n')
+            store_file.flush()
+            os.fsync(store_file.fileno())
+        return record
+
+    # all records, optionally only those of a dataset and method
+    def records(self, dataset_hash = None, method = None):
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path) as store_file:
+            for line in store_file:
+                # skip a line cut short by a crash
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if dataset_hash is not None and record['dataset_hash'] != dataset_hash:
+                    continue
+                if method is not None and record['method'] != method:
+                    continue
+                records.append(record)
+        return records
+
+    # the record with the lowest badness of a dataset and method, or None
+    def best(self, dataset_hash, method):
+        records = self.records(dataset_hash, method)
+        if not records:
+            return None
+        return min(records, key=lambda record: record['badness'])
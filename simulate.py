@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-import matplotlib.pyplot as plt
-from numpy import vstack, size
+from numpy import size
 from time import sleep
 from math import exp
 
@@ -17,13 +16,13 @@ def simulate(p, plot = False):
     
     protein_levels = np.zeros(4) # Protein levels of LacI, TetR, lambdacI and YFP (respectively), which will change in each loop
     
-    protein_levels_plot = np.zeros((0, 4))
-    
     total_time = 10*60*60 + 1
     step = 60
+    # the levels after every step, for plotting
+    protein_levels_plot = np.zeros((len(range(0, total_time, step)), 4))
     # here time increases in 60 second steps.
     # you'll probably want that to be more fine-grained
-    for time in range(0, total_time, step):
+    for i, time in enumerate(range(0, total_time, step)):
         # hypothetical yfp fluorescence level
         
         #params p needs to be decided and defined (e.g. first parameter is repressive effect of LacI on TetR)
@@ -60,7 +59,7 @@ def simulate(p, plot = False):
         
         
         if plot:
-            protein_levels_plot = vstack((protein_levels_plot, protein_levels_new)) 
+            protein_levels_plot[i] = protein_levels_new
         
         protein_levels = protein_levels_new
         
@@ -72,6 +71,8 @@ def simulate(p, plot = False):
             yfp_levels.append(protein_levels_new[3])
     
     if plot:
+        # only imported when needed, so importing this module stays fast
+        import matplotlib.pyplot as plt
         n_rows = total_time / step
         x = range(0, int(n_rows) + 1)
         plt.plot(x, protein_levels_plot[:,0], 'r', label='LacI')
@@ -83,6 +84,328 @@ def simulate(p, plot = False):
     return yfp_levels
 
 
+# observation times (in seconds) at which the yfp levels are recorded
+observation_times = (4*60*60, 6*60*60, 8*60*60, 10*60*60)
+# number of one-minute steps of a simulation
+trajectory_steps = 10*60 + 1
+
+
+# simulate K systems at once
+# P: (K, 19) array, each row is a parameter vector as passed to simulate()
+# fidelity: 1 for the one-minute steps of simulate(), n for steps of n minutes
+# after a warmup of about an hour (n has to divide the two hours between
+# observations)
+# trajectories: optional (K, trajectory_steps, 4) array that is filled with the
+# levels of LacI, TetR, lambdacI and YFP after every step (fidelity 1 only),
+# the same as simulate(plot = True) plots
+# returns a (K, 4) array with the yfp levels after 4, 6, 8 and 10 hours
+# simulate() is kept as the reference implementation; this computes the same
+# recurrence, but advances all K systems together as numpy arrays
+def simulate_batch(P, fidelity = 1, trajectories = None):
+    P = np.atleast_2d(np.asarray(P, dtype=float))
+    K = P.shape[0]
+    yfp_levels = np.zeros((K, len(observation_times)))
+    step = 60 * fidelity
+    if any(t % step for t in observation_times):
+        raise ValueError("fidelity %s doesn't fit the observation times" % str(fidelity))
+    if trajectories is not None and (fidelity != 1 or trajectories.shape != (K, trajectory_steps, 4)):
+        raise ValueError("trajectories need fidelity 1 and an array of shape (%d, %d, 4)" % (K, trajectory_steps))
+
+    # protein levels of LacI, TetR, lambdacI and YFP
+    lacI = np.zeros(K)
+    tetR = np.zeros(K)
+    cI = np.zeros(K)
+    yfp = np.zeros(K)
+
+    # everything that doesn't depend on the protein levels is computed once
+    decay = 1 - P[:, 0]
+    decay_yfp = 1 - P[:, 0] / 3
+    if fidelity != 1:
+        # one step of n minutes: the decay compounds, and the production of each
+        # minute decays for the rest of the step. The production is taken to
+        # change linearly from its value at the start of the step to its value
+        # at the end, where the levels are first estimated with the production
+        # at the start (exact for constant production)
+        decay_step = decay**fidelity
+        decay_yfp_step = decay_yfp**fidelity
+        gain = (1 - decay_step) / P[:, 0]
+        gain_yfp = (1 - decay_yfp_step) / (P[:, 0] / 3)
+        # what is left at the end of the step of a production that rises
+        # linearly by 1 during it
+        ramp = sum(k * decay**(fidelity - 1 - k) for k in range(fidelity)) / fidelity
+        ramp_yfp = sum(k * decay_yfp**(fidelity - 1 - k) for k in range(fidelity)) / fidelity
+    leak_lacI = 1 - P[:, 9]
+    leak_tetR = 1 - P[:, 8]
+    tetR_inh = P[:, 11] * P[:, 10]
+    lacI_pos = 1 + P[:, 15]
+    tetR_pos = 1 + P[:, 16]
+    cI_pos = 1 + P[:, 17]
+
+    # the repressors build up within the first minutes, too fast for coarse
+    # steps, so (about) the first hour always uses one-minute steps.
+    # As in simulate(), the levels "at" time t are those after t/60 + 1 steps,
+    # i.e. a step is labelled with the time it ends at minus one minute, and a
+    # coarse step of n minutes after the step labelled t is labelled t + n
+    # minutes. warmup (the number of one-minute steps) is 1 modulo n, so the
+    # observation times are labels of coarse steps.
+    warmup = fidelity * int(np.ceil(59.0 / fidelity)) + 1
+    times = list(range(0, 60 * warmup, 60)) + list(range(60 * (warmup - 1) + step, 10*60*60 + 1, step))
+    # the production of LacI, TetR, lambdacI and YFP per minute at the given
+    # protein levels
+    def production(lacI, tetR, cI):
+        lacI_inh_lacI = P[:, 9] + leak_lacI / (1 + P[:, 4] * lacI)
+        lacI_inh_tetR = P[:, 9] + leak_lacI / (1 + P[:, 5] * lacI)
+        tetR_inh_cI   = P[:, 8] + leak_tetR / (1 + P[:, 6] * tetR)
+        cI_inh_YFP    =              1     / (1 + P[:, 7] * cI)
+
+        lacI_production = lacI_inh_lacI * P[:, 2] * lacI_pos
+        tetR_production = tetR_inh * lacI_inh_tetR * P[:, 2] * tetR_pos
+        cI_production   = tetR_inh_cI * P[:, 3] * cI_pos
+        YFP_production  = cI_inh_YFP * P[:, 1]
+
+        # supercoiling
+        lacI_factor = 1 - P[:, 12] * (1 - np.exp(- (lacI_production * tetR_production) / P[:, 18]))
+        tetR_factor = 1 - P[:, 12] * (1 - np.exp(- (lacI_production * cI_production) / P[:, 18]))
+        cI_factor =   1 - P[:, 12] * (1 - np.exp(- (tetR_production * cI_production) / P[:, 18]))
+        return (lacI_production * lacI_factor, tetR_production * tetR_factor, cI_production * cI_factor,
+                YFP_production)
+
+    for i, time in enumerate(times):
+        coarse = i >= warmup
+        lacI_p, tetR_p, cI_p, yfp_p = production(lacI, tetR, cI)
+        if fidelity != 1 and coarse:
+            # estimate of the production at the end of the step
+            lacI_e, tetR_e, cI_e, yfp_e = production(decay_step * lacI + gain * lacI_p,
+                                                     decay_step * tetR + gain * tetR_p,
+                                                     decay_step * cI + gain * cI_p)
+            lacI = decay_step * lacI + gain * lacI_p + ramp * (lacI_e - lacI_p)
+            tetR = decay_step * tetR + gain * tetR_p + ramp * (tetR_e - tetR_p)
+            cI = decay_step * cI + gain * cI_p + ramp * (cI_e - cI_p)
+            yfp = decay_yfp_step * yfp + gain_yfp * yfp_p + ramp_yfp * (yfp_e - yfp_p)
+        else:
+            lacI = decay * lacI + lacI_p
+            tetR = decay * tetR + tetR_p
+            cI = decay * cI + cI_p
+            yfp = decay_yfp * yfp + yfp_p
+
+        if trajectories is not None:
+            trajectories[:, i, 0] = lacI
+            trajectories[:, i, 1] = tetR
+            trajectories[:, i, 2] = cI
+            trajectories[:, i, 3] = yfp
+
+        if time in observation_times:
+            yfp_levels[:, observation_times.index(time)] = yfp
+
+    return yfp_levels
+
+
+# simulate_batch that also propagates the forward sensitivities of the state
+# with respect to all 19 parameters (at full fidelity)
+# P: (K, 19) array of parameters
+# returns a (K, 4) array with the yfp levels after 4, 6, 8 and 10 hours and a
+# (K, 4, 19) array with their derivatives with respect to the parameters
+def simulate_batch_sensitivities(P):
+    P = np.atleast_2d(np.asarray(P, dtype=float))
+    K = P.shape[0]
+    yfp_levels = np.zeros((K, len(observation_times)))
+    yfp_sens = np.zeros((K, len(observation_times), 19))
+
+    # unit vectors: the derivative of parameter k with respect to the parameters
+    unit = np.eye(19)
+
+    lacI, tetR, cI, yfp = np.zeros((4, K))
+    # derivatives of the protein levels with respect to the parameters
+    d_lacI, d_tetR, d_cI, d_yfp = np.zeros((4, K, 19))
+
+    # derivative of q + (1 - q) / (1 + r * x) where r * x is the repression
+    def inhibition(q, r, x, dx, k_q, k_r):
+        denom = 1 + P[:, r] * x
+        value = P[:, q] + (1 - P[:, q]) / denom
+        d_denom = unit[k_r] * x[:, None] + P[:, r, None] * dx
+        d_value = unit[k_q] * (1 - 1 / denom)[:, None] - ((1 - P[:, q]) / denom**2)[:, None] * d_denom
+        return value, d_value
+
+    # derivative of 1 - p12 * (1 - exp(-a * b / p18))
+    def supercoiling(a, da, b, db):
+        E = np.exp(- (a * b) / P[:, 18])
+        d_E = E[:, None] * (- (da * b[:, None] + a[:, None] * db) / P[:, 18, None]
+                            + ((a * b) / P[:, 18]**2)[:, None] * unit[18])
+        value = 1 - P[:, 12] * (1 - E)
+        d_value = - unit[12] * (1 - E)[:, None] + P[:, 12, None] * d_E
+        return value, d_value
+
+    # the constant factors of the productions and their derivatives
+    lacI_max = P[:, 2] * (1 + P[:, 15])
+    d_lacI_max = (1 + P[:, 15, None]) * unit[2] + P[:, 2, None] * unit[15]
+    tetR_max = P[:, 11] * P[:, 10] * P[:, 2] * (1 + P[:, 16])
+    d_tetR_max = ((P[:, 10] * P[:, 2] * (1 + P[:, 16]))[:, None] * unit[11]
+                  + (P[:, 11] * P[:, 2] * (1 + P[:, 16]))[:, None] * unit[10]
+                  + (P[:, 11] * P[:, 10] * (1 + P[:, 16]))[:, None] * unit[2]
+                  + (P[:, 11] * P[:, 10] * P[:, 2])[:, None] * unit[16])
+    cI_max = P[:, 3] * (1 + P[:, 17])
+    d_cI_max = (1 + P[:, 17, None]) * unit[3] + P[:, 3, None] * unit[17]
+
+    for time in range(0, 10*60*60 + 1, 60):
+        lacI_inh_lacI, d_lacI_inh_lacI = inhibition(9, 4, lacI, d_lacI, 9, 4)
+        lacI_inh_tetR, d_lacI_inh_tetR = inhibition(9, 5, lacI, d_lacI, 9, 5)
+        tetR_inh_cI, d_tetR_inh_cI = inhibition(8, 6, tetR, d_tetR, 8, 6)
+        denom = 1 + P[:, 7] * cI
+        cI_inh_YFP = 1 / denom
+        d_cI_inh_YFP = - (1 / denom**2)[:, None] * (unit[7] * cI[:, None] + P[:, 7, None] * d_cI)
+
+        # production = inhibition * constant, so d(production) = d(inhibition) * constant + inhibition * d(constant)
+        lacI_production = lacI_inh_lacI * lacI_max
+        d_lacI_production = d_lacI_inh_lacI * lacI_max[:, None] + lacI_inh_lacI[:, None] * d_lacI_max
+        tetR_production = lacI_inh_tetR * tetR_max
+        d_tetR_production = d_lacI_inh_tetR * tetR_max[:, None] + lacI_inh_tetR[:, None] * d_tetR_max
+        cI_production = tetR_inh_cI * cI_max
+        d_cI_production = d_tetR_inh_cI * cI_max[:, None] + tetR_inh_cI[:, None] * d_cI_max
+        YFP_production = cI_inh_YFP * P[:, 1]
+        d_YFP_production = d_cI_inh_YFP * P[:, 1, None] + cI_inh_YFP[:, None] * unit[1]
+
+        lacI_factor, d_lacI_factor = supercoiling(lacI_production, d_lacI_production, tetR_production, d_tetR_production)
+        tetR_factor, d_tetR_factor = supercoiling(lacI_production, d_lacI_production, cI_production, d_cI_production)
+        cI_factor, d_cI_factor = supercoiling(tetR_production, d_tetR_production, cI_production, d_cI_production)
+
+        d_lacI = (- unit[0] * lacI[:, None] + (1 - P[:, 0, None]) * d_lacI
+                  + d_lacI_production * lacI_factor[:, None] + lacI_production[:, None] * d_lacI_factor)
+        d_tetR = (- unit[0] * tetR[:, None] + (1 - P[:, 0, None]) * d_tetR
+                  + d_tetR_production * tetR_factor[:, None] + tetR_production[:, None] * d_tetR_factor)
+        d_cI = (- unit[0] * cI[:, None] + (1 - P[:, 0, None]) * d_cI
+                + d_cI_production * cI_factor[:, None] + cI_production[:, None] * d_cI_factor)
+        d_yfp = - unit[0] * (yfp / 3)[:, None] + (1 - P[:, 0, None] / 3) * d_yfp + d_YFP_production
+
+        lacI = (1 - P[:, 0]) * lacI + lacI_production * lacI_factor
+        tetR = (1 - P[:, 0]) * tetR + tetR_production * tetR_factor
+        cI = (1 - P[:, 0]) * cI + cI_production * cI_factor
+        yfp = (1 - P[:, 0] / 3) * yfp + YFP_production
+
+        if time in observation_times:
+            yfp_levels[:, observation_times.index(time)] = yfp
+            yfp_sens[:, observation_times.index(time)] = d_yfp
+
+    return yfp_levels, yfp_sens
+
+
+# Continuous-time formulation of the same model. The recurrence above is the
+# explicit Euler discretisation (with a step of one minute) of
+#   d/dt protein = (production * factor - p[0] * protein) / 60
+# for LacI, TetR and cI, and of
+#   d/dt YFP = (YFP production - p[0] / 3 * YFP) / 60
+# where t is in seconds and production and factor are computed as above.
+# P: (K, 19) parameters, x: (K, 4) protein levels
+# returns a (K, 4) array of the rates of change
+def derivatives_batch(P, x):
+    lacI_inh_lacI = P[:, 9] + (1 - P[:, 9]) / (1 + P[:, 4] * x[:, 0])
+    lacI_inh_tetR = P[:, 9] + (1 - P[:, 9]) / (1 + P[:, 5] * x[:, 0])
+    tetR_inh_cI   = P[:, 8] + (1 - P[:, 8]) / (1 + P[:, 6] * x[:, 1])
+    cI_inh_YFP    =              1         / (1 + P[:, 7] * x[:, 2])
+
+    lacI_production = lacI_inh_lacI * P[:, 2] * (1 + P[:, 15])
+    tetR_production = P[:, 11] * P[:, 10] * lacI_inh_tetR * P[:, 2] * (1 + P[:, 16])
+    cI_production   = tetR_inh_cI * P[:, 3] * (1 + P[:, 17])
+    YFP_production  = cI_inh_YFP * P[:, 1]
+
+    lacI_factor = 1 - P[:, 12] * (1 - np.exp(- (lacI_production * tetR_production) / P[:, 18]))
+    tetR_factor = 1 - P[:, 12] * (1 - np.exp(- (lacI_production * cI_production) / P[:, 18]))
+    cI_factor =   1 - P[:, 12] * (1 - np.exp(- (tetR_production * cI_production) / P[:, 18]))
+
+    rates = np.empty_like(x)
+    rates[:, 0] = lacI_production * lacI_factor - P[:, 0] * x[:, 0]
+    rates[:, 1] = tetR_production * tetR_factor - P[:, 0] * x[:, 1]
+    rates[:, 2] = cI_production * cI_factor - P[:, 0] * x[:, 2]
+    rates[:, 3] = YFP_production - P[:, 0] / 3 * x[:, 3]
+    return rates / 60
+
+
+# Dormand-Prince 5(4) coefficients
+_dp_c = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+_dp_a = [[],
+         [1/5],
+         [3/40, 9/40],
+         [44/45, -56/15, 32/9],
+         [19372/6561, -25360/2187, 64448/6561, -212/729],
+         [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+         [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+# difference between the 5th and the embedded 4th order solution
+_dp_e = np.array([71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40])
+# coefficients of the 4th order continuous extension (dense output):
+# x(t + theta*h) = x + h * sum_i k_i * (P_i1*theta + P_i2*theta^2 + P_i3*theta^3 + P_i4*theta^4)
+_dp_p = np.array([
+    [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+    [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+    [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+    [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+    [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+
+# integrate the continuous-time model for K systems with an adaptive step
+# P: (K, 19) array of parameters
+# times: observation times in seconds, the integration stops at the last one
+# rtol, atol: relative and absolute tolerance of the local error per step
+# full: return the levels of all 4 proteins instead of only yfp
+# returns a (K, len(times)) array of yfp levels (or (K, len(times), 4) if full)
+# and the number of accepted steps. All K systems share the step size, which
+# is chosen so that the worst of them stays within the tolerances. Values at
+# the observation times come from the 4th order dense output of the step.
+def simulate_ode_batch(P, times = observation_times, rtol = 1e-4, atol = 1e-6, full = False,
+                       max_steps = 100000):
+    P = np.atleast_2d(np.asarray(P, dtype=float))
+    times = np.asarray(times, dtype=float)
+    K = P.shape[0]
+    levels = np.zeros((K, len(times), 4))
+    x = np.zeros((K, 4))
+    t = 0.0
+    # observations at the start time need no integration
+    obs = 0
+    while obs < len(times) and times[obs] <= t:
+        levels[:, obs] = x
+        obs += 1
+    f = derivatives_batch(P, x)
+    h = 60.0
+    steps = 0
+    k = np.empty((7, K, 4))
+    while obs < len(times):
+        if steps >= max_steps:
+            raise RuntimeError("simulate_ode_batch: more than %d steps needed" % max_steps)
+        h = min(h, times[-1] - t)
+        k[0] = f
+        for i in range(1, 7):
+            x_stage = x + h * np.tensordot(_dp_a[i], k[:i], axes=1)
+            k[i] = derivatives_batch(P, x_stage)
+        # the last stage is evaluated at the 5th order solution
+        x_new = x_stage
+        error = h * np.tensordot(_dp_e, k, axes=1)
+        scale = atol + rtol * np.maximum(np.abs(x), np.abs(x_new))
+        err = np.sqrt(np.max(np.mean((error / scale)**2, axis=1))) if K else 0.0
+        if err <= 1:
+            f_new = k[6]
+            t_new = t + h
+            # dense output for all observations inside this step
+            while obs < len(times) and times[obs] <= t_new:
+                theta = (times[obs] - t) / h
+                weights = _dp_p.dot(theta ** np.arange(1, 5))
+                levels[:, obs] = x + h * np.tensordot(weights, k, axes=1)
+                obs += 1
+            t, x, f = t_new, x_new, f_new
+            steps += 1
+        # standard step size control with safety factor and bounded change
+        h *= min(5.0, max(0.2, 0.9 * (err if err > 0 else 1e-10)**(-0.2)))
+    if full:
+        return levels, steps
+    return levels[:, :, 3], steps
+
+
+# simulate the continuous-time model for one system with parameters p
+# returns the yfp levels at the observation times
+def simulate_ode(p, times = observation_times, rtol = 1e-4, atol = 1e-6):
+    yfps, _ = simulate_ode_batch(p, times, rtol, atol)
+    return list(yfps[0])
+
+
 # test output
 # print(simulate([1,1,1]))
 
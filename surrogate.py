@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Surrogate model for pre-screening candidates in optimize().
+#
+# A gaussian process regression on the log badness of the most recent
+# evaluations, in the parameter space scaled to [0, 1] by the ranges. It
+# predicts the log badness of a candidate with an uncertainty, and only
+# candidates that might beat the current best (lower confidence bound below
+# it) are forwarded to the real evaluation. A small fraction of the rejected
+# candidates is evaluated anyway to check how often the surrogate is wrong.
+#
+# The length scale of the kernel is the median distance between the stored
+# points, but at most the typical distance of a proposal from the current
+# values (set_width), otherwise points from the wide early proposals make
+# the predictions around the current values overconfident.
+#
+# The kernel matrix is kept as its cholesky factor, which is extended by a
+# row for every evaluation added and updated in place when the oldest one is
+# dropped, so adding costs O(n^2) for n stored evaluations; only a change of
+# the length scale needs a full refactorization.
+
+
+# solve L x = b for a lower triangular L, or L^T x = b with transpose
+def solve_triangular(L, b, transpose = False):
+    x = np.zeros(len(b))
+    if transpose:
+        for i in range(len(b) - 1, -1, -1):
+            x[i] = (b[i] - L[i + 1:, i].dot(x[i + 1:])) / L[i, i]
+    else:
+        for i in range(len(b)):
+            x[i] = (b[i] - L[i, :i].dot(x[:i])) / L[i, i]
+    return x
+
+
+# the cholesky factor of L L^T + x x^T for a lower triangular L
+def cholesky_update(L, x):
+    L = L.copy()
+    x = x.copy()
+    for k in range(len(x)):
+        r = np.hypot(L[k, k], x[k])
+        c = r / L[k, k]
+        s = x[k] / L[k, k]
+        L[k, k] = r
+        L[k + 1:, k] = (L[k + 1:, k] + s * x[k + 1:]) / c
+        x[k + 1:] = c * x[k + 1:] - s * L[k + 1:, k]
+    return L
+
+
+class Surrogate():
+
+    # mins, maxs: the parameter ranges
+    # capacity: maximum number of evaluations kept, the oldest are dropped
+    # min_points: don't screen before this many evaluations were added
+    # kappa: candidates are forwarded if mean - kappa * std is below the best
+    # noise: noise variance relative to the signal variance
+    # audit: fraction of rejected candidates that is evaluated anyway
+    # seed: seed of the random numbers for the audit
+    def __init__(self, mins, maxs, capacity = 200, min_points = 20, kappa = 2.0, noise = 1e-4,
+                 audit = 0.05, seed = 0):
+        self.mins = np.asarray(mins, dtype=float)
+        ranges = np.asarray(maxs, dtype=float) - self.mins
+        self.free = ranges > 0
+        self.ranges = np.where(self.free, ranges, 1)
+        self.capacity = capacity
+        self.min_points = min_points
+        self.kappa = kappa
+        self.noise = noise
+        self.audit = audit
+        self.rng = np.random.RandomState(seed)
+        # upper bound of the length scale, see set_width
+        self.max_length_scale = None
+        self.reset()
+        # forwarded: candidates passed on to the real evaluation
+        # hits: forwarded candidates that were better than the incumbent
+        # skipped: candidates not evaluated because of the surrogate
+        # audited: rejected candidates that were evaluated anyway
+        # false_skips: audited candidates that would have been better
+        self.forwarded = 0
+        self.hits = 0
+        self.skipped = 0
+        self.audited = 0
+        self.false_skips = 0
+
+    # forget all evaluations, e.g. when the badness changes its meaning
+    def reset(self):
+        self.Z = np.zeros((0, np.count_nonzero(self.free)))
+        self.y = np.zeros(0)
+        self.L = np.zeros((0, 0))
+        self.length_scale = 0.3
+        # the weights of the stored evaluations in the predicted mean, computed
+        # when needed after the evaluations changed
+        self.alpha = None
+
+    def scale(self, p):
+        return ((np.asarray(p, dtype=float) - self.mins) / self.ranges)[self.free]
+
+    def kernel(self, A, B):
+        d2 = np.sum((A[:, None, :] - B[None, :, :])**2, axis=2)
+        return np.exp(-d2 / (2 * self.length_scale**2))
+
+    # refactorize the kernel matrix from scratch, also re-estimating the
+    # length scale as the median distance between the stored points
+    def refit(self):
+        if len(self.y) > 1:
+            d = np.sqrt(np.sum((self.Z[:, None, :] - self.Z[None, :, :])**2, axis=2))
+            median = np.median(d[np.triu_indices(len(self.y), 1)])
+            if median > 0:
+                self.length_scale = median
+        if self.max_length_scale is not None:
+            self.length_scale = min(self.length_scale, self.max_length_scale)
+        K = self.kernel(self.Z, self.Z) + self.noise * np.eye(len(self.y))
+        self.L = np.linalg.cholesky(K)
+        self.alpha = None
+
+    # the standard deviation of the proposals relative to the ranges (the
+    # temperature in optimize); bounds the length scale by the typical
+    # distance of a proposal, refitting when the bound changes by more than
+    # 10% and the length scale is above it
+    def set_width(self, width):
+        bound = width * np.sqrt(np.count_nonzero(self.free))
+        if self.max_length_scale is not None and abs(bound - self.max_length_scale) <= 0.1 * self.max_length_scale:
+            return
+        self.max_length_scale = bound
+        if self.length_scale > bound and len(self.y):
+            self.refit()
+        else:
+            self.length_scale = min(self.length_scale, bound)
+
+    # add an evaluation, dropping the oldest one if the capacity is reached;
+    # the cholesky factor is extended by one row
+    def add(self, p, badness):
+        z = self.scale(p)
+        y = np.log(max(badness, 1e-300))
+        if len(self.y) >= self.capacity:
+            # without the first row and column, the kernel matrix is
+            # L22 L22^T + l21 l21^T of the blocks of its factor
+            self.L = cholesky_update(self.L[1:, 1:], self.L[1:, 0])
+            self.Z = self.Z[1:]
+            self.y = self.y[1:]
+        k = self.kernel(self.Z, z[None])[:, 0]
+        l = solve_triangular(self.L, k)
+        d = np.sqrt(max(1 + self.noise - l.dot(l), 1e-12))
+        n = len(self.y)
+        L = np.zeros((n + 1, n + 1))
+        L[:n, :n] = self.L
+        L[n, :n] = l
+        L[n, n] = d
+        self.L = L
+        self.Z = np.vstack((self.Z, z))
+        self.y = np.append(self.y, y)
+        self.alpha = None
+        if len(self.y) == self.min_points:
+            self.refit()
+
+    # predicted log badness of p and its standard deviation
+    def predict(self, p):
+        z = self.scale(p)
+        mean = np.mean(self.y)
+        variance = np.var(self.y) + 1e-12
+        if self.alpha is None:
+            self.alpha = solve_triangular(self.L, solve_triangular(self.L, self.y - mean), transpose = True)
+        k = self.kernel(self.Z, z[None])[:, 0]
+        v = solve_triangular(self.L, k)
+        return mean + k.dot(self.alpha), np.sqrt(variance * max(1 - v.dot(v), 0))
+
+    # should the candidate p be evaluated, given the current best badness?
+    # returns 'forward' if it might be better, 'audit' if it probably isn't
+    # but was picked for checking the surrogate, and 'skip' otherwise
+    def screen(self, p, badness):
+        if len(self.y) < self.min_points:
+            return 'forward'
+        mean, std = self.predict(p)
+        if mean - self.kappa * std < np.log(max(badness, 1e-300)):
+            return 'forward'
+        if self.rng.uniform() < self.audit:
+            self.audited += 1
+            return 'audit'
+        self.skipped += 1
+        return 'skip'
+
+    # record the result of an evaluation that screen() let through
+    # decision: what screen() returned for p
+    def record(self, p, badness_new, badness, decision):
+        self.add(p, badness_new)
+        if decision == 'audit':
+            if badness_new < badness:
+                self.false_skips += 1
+            return
+        self.forwarded += 1
+        if badness_new < badness:
+            self.hits += 1
+
+    def print_stats(self):
+        print("surrogate: %d forwarded (%d better), %d skipped, %d of %d audited skips would have been better" %
+              (self.forwarded, self.hits, self.skipped, self.false_skips, self.audited))
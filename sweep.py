@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import json
+import multiprocessing
+import os
+
+# Parameter sweeps and global sensitivity analysis.
+#
+# A sweep evaluates a design (grid, latin hypercube or sobol sequence) over a
+# subset of the parameters within their ranges, the other parameters stay at
+# their base values. Every point of a design is a function of its index only,
+# so chunks of points can be generated and evaluated anywhere, in any order.
+#
+# The results are streamed to a directory with one raw file per column:
+#   meta.json:     description of the sweep
+#   p<i>.f64:      value of the swept parameter i
+#   badness.f64:   total badness
+#   strains.f64:   badness of every strain, one row of strain_count values
+#   progress.json: number of rows that are completely written
+# The column files are only appended to, and progress.json is replaced after
+# every chunk. An interrupted sweep is resumed by truncating the columns to
+# the committed rows and continuing with the next chunk.
+
+
+# design descriptions (stored in meta.json):
+#   {'kind': 'grid', 'levels': L}  L values per parameter including the bounds
+#   {'kind': 'lhs', 'n': n, 'seed': s}  latin hypercube of n points
+#   {'kind': 'sobol', 'n': n}  first n points of the sobol sequence
+def design_size(design, dims):
+    if design['kind'] == 'grid':
+        return design['levels']**dims
+    return design['n']
+
+
+# points start, ..., stop-1 of a design in the unit box
+# returns a (stop-start, dims) array
+def design_points(design, dims, start, stop):
+    index = np.arange(start, stop)
+    if design['kind'] == 'grid':
+        return grid_points(index, dims, design['levels'])
+    if design['kind'] == 'lhs':
+        return lhs_points(index, dims, design['n'], design['seed'])
+    if design['kind'] == 'sobol':
+        return sobol_points(index, dims)
+    raise ValueError("unknown design %s" % design['kind'])
+
+
+def grid_points(index, dims, levels):
+    # the digits of the index in base levels, the last parameter varies fastest
+    digits = (index[:, None] // levels**np.arange(dims - 1, -1, -1)) % levels
+    if levels == 1:
+        return np.full((len(index), dims), 0.5)
+    return digits / (levels - 1.0)
+
+
+# integer hash of an array of uint64 (splitmix64), used for random numbers
+# that only depend on the index of a point
+def mix(x):
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+# a keyed random permutation of 0, ..., n-1, evaluated at the indices without
+# storing it: a feistel network on the smallest even number of bits that
+# covers n, with mix as round function. Indices it maps to n or above are
+# mapped again (cycle walking) until they land below n, which keeps it a
+# permutation of 0, ..., n-1.
+def permute(index, n, key, rounds = 4):
+    half = max(1, (int(n - 1).bit_length() + 1) // 2)
+    mask = np.uint64((1 << half) - 1)
+    keys = mix(np.full(rounds, key, dtype=np.uint64) * np.uint64(rounds) + np.arange(rounds, dtype=np.uint64))
+    x = index.astype(np.uint64)
+    walk = np.ones(len(x), dtype=bool)
+    while np.any(walk):
+        left, right = x[walk] >> np.uint64(half), x[walk] & mask
+        for k in keys:
+            left, right = right, left ^ (mix(right ^ k) & mask)
+        x[walk] = (left << np.uint64(half)) | right
+        walk = x >= np.uint64(n)
+    return x
+
+
+# latin hypercube: in every dimension, point i lies in the stratum given by
+# an independent random permutation of the strata (permute), and is jittered
+# uniformly within the stratum
+def lhs_points(index, dims, n, seed):
+    U = np.zeros((len(index), dims))
+    for k in range(dims):
+        strata = permute(index, n, seed * dims + k)
+        keys = mix(np.uint64(seed) * np.uint64(dims * n) + index.astype(np.uint64) * np.uint64(dims) + np.uint64(k))
+        jitter = (keys >> np.uint64(11)).astype(float) / 2.0**53
+        U[:, k] = (strata + jitter) / n
+    return U
+
+
+# primitive polynomials and initial direction numbers of the sobol sequence
+# for the dimensions 2 to 21 (Joe and Kuo): degree s, coefficients a, m_1..m_s
+sobol_table = [(1, 0, [1]),
+               (2, 1, [1, 3]),
+               (3, 1, [1, 3, 1]),
+               (3, 2, [1, 1, 1]),
+               (4, 1, [1, 1, 3, 3]),
+               (4, 4, [1, 3, 5, 13]),
+               (5, 2, [1, 1, 5, 5, 17]),
+               (5, 4, [1, 1, 5, 5, 5]),
+               (5, 7, [1, 1, 7, 11, 19]),
+               (5, 11, [1, 1, 5, 1, 1]),
+               (5, 13, [1, 1, 1, 3, 11]),
+               (5, 14, [1, 3, 5, 5, 31]),
+               (6, 1, [1, 3, 3, 9, 7, 49]),
+               (6, 13, [1, 1, 1, 15, 21, 21]),
+               (6, 16, [1, 3, 1, 13, 27, 49]),
+               (6, 19, [1, 1, 1, 15, 7, 5]),
+               (6, 22, [1, 3, 1, 15, 13, 25]),
+               (6, 25, [1, 1, 5, 5, 19, 61]),
+               (7, 1, [1, 3, 7, 11, 23, 15, 103]),
+               (7, 4, [1, 3, 7, 13, 13, 15, 69])]
+sobol_bits = 32
+
+
+# direction numbers v_1..v_bits of the first dims dimensions as integers
+def sobol_directions(dims):
+    if dims > len(sobol_table) + 1:
+        raise ValueError("sobol designs support at most %d dimensions" % (len(sobol_table) + 1))
+    V = np.zeros((dims, sobol_bits), dtype=np.uint64)
+    V[0] = [1 << (sobol_bits - j) for j in range(1, sobol_bits + 1)]
+    for d in range(1, dims):
+        s, a, m = sobol_table[d - 1]
+        v = [m[j] << (sobol_bits - 1 - j) for j in range(s)]
+        for j in range(s, sobol_bits):
+            x = v[j - s] ^ (v[j - s] >> s)
+            for k in range(1, s):
+                if (a >> (s - 1 - k)) & 1:
+                    x ^= v[j - k]
+            v.append(x)
+        V[d] = v
+    return V
+
+
+# point i of the sobol sequence is the xor of the direction numbers of the
+# bits set in its gray code i ^ (i >> 1)
+def sobol_points(index, dims):
+    V = sobol_directions(dims)
+    gray = (index ^ (index >> 1)).astype(np.uint64)
+    X = np.zeros((len(index), dims), dtype=np.uint64)
+    for bit in range(sobol_bits):
+        set_bit = ((gray >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+        X[set_bit] ^= V[:, bit]
+    return X.astype(float) / 2.0**sobol_bits
+
+
+# the state of the worker processes, set once by the pool initializer
+worker = {}
+
+
+def _init_worker(evaluator, meta):
+    worker['evaluator'] = evaluator
+    worker['meta'] = meta
+
+
+# evaluate the points start, ..., stop-1 of the sweep
+# returns the values of the swept parameters and the badness of every strain
+def _evaluate_chunk(bounds):
+    start, stop = bounds
+    meta = worker['meta']
+    swept = meta['params']
+    mins = np.array(meta['mins'])[swept]
+    maxs = np.array(meta['maxs'])[swept]
+    U = design_points(meta['design'], len(swept), start, stop)
+    P = np.tile(np.array(meta['base'], dtype=float), (len(U), 1))
+    P[:, swept] = mins + U * (maxs - mins)
+    strain_badness = worker['evaluator'].get_strain_badness_batch(P, meta['method'], meta['fidelity'])
+    return P[:, swept], strain_badness
+
+
+def column_names(meta):
+    return ['p%d' % i for i in meta['params']] + ['badness', 'strains']
+
+
+def column_width(meta, name):
+    return meta['strain_count'] if name == 'strains' else 1
+
+
+def read_progress(out_dir):
+    path = os.path.join(out_dir, 'progress.json')
+    if not os.path.exists(path):
+        return 0
+    with open(path) as progress_file:
+        return json.load(progress_file)['rows']
+
+
+# replace the progress file atomically, so it never claims unwritten rows
+def write_progress(out_dir, rows):
+    path = os.path.join(out_dir, 'progress.json')
+    with open(path + '.tmp', 'w') as progress_file:
+        json.dump({'rows': rows}, progress_file)
+        progress_file.flush()
+        os.fsync(progress_file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+# sweep the parameters with the indices params over their ranges
+# evaluator: anything with get_strain_badness_batch(P, method, fidelity),
+#            e.g. a ParamEvaluator; it is pickled into every worker process
+# out_dir: directory of the results, an existing sweep with the same
+#          description is resumed
+# design: see design_size
+# base: values of the parameters that aren't swept
+# chunk: points evaluated in one batch
+# processes: number of worker processes (default: all cores), 1 evaluates
+#            the chunks in this process
+# returns the number of points in the sweep
+def run_sweep(evaluator, out_dir, design, params, base, mins, maxs, method, fidelity = 1, chunk = 1000,
+              processes = None, debug = 1):
+    params = [int(i) for i in params]
+    meta = {'design': design,
+            'params': params,
+            'base': [float(x) for x in base],
+            'mins': [float(x) for x in mins],
+            'maxs': [float(x) for x in maxs],
+            'method': int(method),
+            'fidelity': int(fidelity),
+            'dataset': getattr(evaluator, 'dataset_hash', None),
+            'strain_count': int(evaluator.strain_count)}
+    n = design_size(design, len(params))
+    meta['n'] = n
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    meta_path = os.path.join(out_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            if json.load(meta_file) != meta:
+                raise ValueError("%s holds a different sweep" % out_dir)
+    else:
+        with open(meta_path, 'w') as meta_file:
+            json.dump(meta, meta_file, indent=1)
+
+    # drop whatever was written after the last committed chunk
+    rows = read_progress(out_dir)
+    columns = {}
+    for name in column_names(meta):
+        path = os.path.join(out_dir, name + '.f64')
+        columns[name] = open(path, 'ab')
+        columns[name].truncate(rows * column_width(meta, name) * 8)
+    if debug >= 1 and rows > 0:
+        print("resuming sweep at point %d of %d" % (rows, n))
+
+    chunks = [(start, min(start + chunk, n)) for start in range(rows, n, chunk)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    if processes > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (evaluator, meta))
+        results = pool.imap(_evaluate_chunk, chunks)
+    else:
+        _init_worker(evaluator, meta)
+        results = map(_evaluate_chunk, chunks)
+    try:
+        # the chunks arrive in order, so the rows are appended in order
+        for (start, stop), (values, strain_badness) in zip(chunks, results):
+            for j, i in enumerate(params):
+                columns['p%d' % i].write(np.ascontiguousarray(values[:, j], dtype='<f8').tobytes())
+            columns['badness'].write(np.sum(strain_badness, axis=1).astype('<f8').tobytes())
+            columns['strains'].write(np.ascontiguousarray(strain_badness, dtype='<f8').tobytes())
+            for column in columns.values():
+                column.flush()
+                os.fsync(column.fileno())
+            write_progress(out_dir, stop)
+            if debug >= 1:
+                print("sweep: %d of %d points" % (stop, n))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for column in columns.values():
+            column.close()
+    return n
+
+
+# memory map the committed rows of a sweep
+# returns the description and a dictionary of read-only column arrays
+def load_sweep(out_dir):
+    with open(os.path.join(out_dir, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+    rows = read_progress(out_dir)
+    columns = {}
+    for name in column_names(meta):
+        width = column_width(meta, name)
+        shape = (rows, width) if name == 'strains' else (rows,)
+        if rows * width == 0:
+            columns[name] = np.zeros(shape)
+        else:
+            columns[name] = np.memmap(os.path.join(out_dir, name + '.f64'), dtype='<f8', mode='r', shape=shape)
+    return meta, columns
+
+
+# first order sensitivity indices of the swept parameters
+# S_i = Var(E[y | x_i]) / Var(y), where E[y | x_i] is estimated by the mean of
+# y in each of bins equally wide bins of the range of x_i. This works for any
+# design with many points per bin; the estimate is biased upwards by about
+# bins / points.
+# y is the total badness (log10 of it if log) or the badness of strain
+# block: rows read at a time, so memory stays flat for any sweep size
+# returns a dictionary from the parameter index to its index
+def sensitivity_indices(out_dir, bins = 20, log = True, strain = None, block = 100000):
+    meta, columns = load_sweep(out_dir)
+    params = meta['params']
+    rows = len(columns['badness'])
+    if rows == 0:
+        raise ValueError("%s has no results yet" % out_dir)
+    counts = np.zeros((len(params), bins))
+    sums = np.zeros((len(params), bins))
+    shift = None
+    total = 0.0
+    total_squares = 0.0
+    for start in range(0, rows, block):
+        stop = min(start + block, rows)
+        y = np.array(columns['badness'][start:stop] if strain is None else columns['strains'][start:stop, strain])
+        if log:
+            y = np.log10(np.maximum(y, 1e-300))
+        # shift by the first value to avoid cancellation in the variance
+        if shift is None:
+            shift = y[0]
+        y = y - shift
+        total += np.sum(y)
+        total_squares += np.sum(y**2)
+        for j, i in enumerate(params):
+            span = meta['maxs'][i] - meta['mins'][i]
+            x = (np.array(columns['p%d' % i][start:stop]) - meta['mins'][i]) / (span if span > 0 else 1)
+            bin_index = np.clip((x * bins).astype(int), 0, bins - 1)
+            counts[j] += np.bincount(bin_index, minlength=bins)
+            sums[j] += np.bincount(bin_index, weights=y, minlength=bins)
+    mean = total / rows
+    variance = total_squares / rows - mean**2
+    indices = {}
+    for j, i in enumerate(params):
+        filled = counts[j] > 0
+        between = np.sum(counts[j][filled] * (sums[j][filled] / counts[j][filled] - mean)**2) / rows
+        indices[i] = float(between / variance) if variance > 0 else 0.0
+    return indices
+
+
+def print_sensitivity(indices):
+    for i, index in sorted(indices.items(), key=lambda item: -item[1]):
+        print("parameter %2d: %.4f" % (i, index))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+# Instrumentation of the hot paths and a stream of events from optimize().
+#
+# The module has a single Telemetry instance, telemetry, which is disabled
+# until enable() is called. While disabled, timer() returns a shared object
+# that does nothing and the other methods return right away, so the
+# instrumented code costs a few attribute lookups per call.
+#
+# Enabled, the time spent in each timer and the counters are accumulated and
+# written with every event, one json object per line:
+#   {"event": ..., "time": seconds since enable(), "timers": {...},
+#    "counters": {...}, <fields of the event>}
+# The timers and counters are those since the previous event. Every process
+# has its own instance, so worker processes (tempering, sweeps, brokers) are
+# not included.
+
+
+class Timer():
+
+    def __init__(self, totals, name):
+        self.totals = totals
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.totals[self.name] = self.totals.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class NullTimer():
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+null_timer = NullTimer()
+
+
+class Telemetry():
+
+    def __init__(self):
+        self.enabled = False
+        self.output = None
+        self.timers = {}
+        self.counters = {}
+        # the latest value of things that are expensive to recompute, like
+        # the badness of every strain of the last evaluation
+        self.values = {}
+
+    # start writing events to the file path (appending to it)
+    def enable(self, path):
+        self.disable()
+        self.output = open(path, 'a')
+        self.start = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.values = {}
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+    # time a block of code: with telemetry.timer('simulate'): ...
+    def timer(self, name):
+        if not self.enabled:
+            return null_timer
+        return Timer(self.timers, name)
+
+    def count(self, name, n = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        if self.enabled:
+            self.values[name] = value
+
+    def get(self, name):
+        return self.values.get(name)
+
+    # write an event with the given fields, and reset the timers and counters
+    def emit(self, event, **fields):
+        if not self.enabled:
+            return
+        record = {'event': event, 'time': time.time() - self.start, 'timers': self.timers, 'counters': self.counters}
+        record.update(fields)
+        self.output.write(json.dumps(record) + '\n')
+        self.output.flush()
+        self.timers = {}
+        self.counters = {}
+
+
+telemetry = Telemetry()
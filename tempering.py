@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from multiprocessing import Pool
+
+# Parallel tempering: R replicas explore the parameter space at different
+# temperatures, each one in its own process, and every round neighbouring
+# replicas may swap their states. Hot replicas make big jumps and accept
+# worse states easily, cold ones refine, and good states found by hot
+# replicas wander down the ladder.
+#
+# The energy of a state is log(badness), so temperatures are relative:
+# at temperature t, a state that is t*100 percent worse is accepted with
+# probability 1/e. This makes the same ladder usable for all four methods.
+
+# the function the worker processes evaluate, set once by _init_worker so
+# that it isn't pickled again for every round
+_func = None
+
+
+def _init_worker(func):
+    global _func
+    _func = func
+
+
+def _energy(badness):
+    return np.log(max(badness, 1e-300))
+
+
+# advance one replica by a number of metropolis steps
+# returns its new state, its best state and the number of accepted steps
+def _run_replica(args):
+    vals, badness, scale, temp, rng, mins, maxs, method, steps = args
+    ranges = maxs - mins
+    best_vals, best_badness = vals, badness
+    accepted = 0
+    for _ in range(steps):
+        vals_new = rng.normal(vals, scale*ranges)
+        vals_new = np.minimum(np.maximum(vals_new, mins), maxs)
+        badness_new = _func(vals_new, method, 0)
+        delta = _energy(badness_new) - _energy(badness)
+        if delta <= 0 or rng.uniform() < np.exp(-delta / temp):
+            vals, badness = vals_new, badness_new
+            accepted += 1
+            if badness < best_badness:
+                best_vals, best_badness = vals, badness
+    return vals, badness, rng, best_vals, best_badness, accepted
+
+
+# func, init, mins, maxs, method, debug: as for optimize()
+# replicas: number of replicas, one per temperature
+# rounds: number of rounds, after each of which neighbours may swap states
+# steps: metropolis steps per replica and round
+# temps: (hottest, coldest) temperature, geometrically spaced in between
+# scales: (hottest, coldest) proposal width relative to the parameter ranges
+# seed: together with the number of replicas, this determines the result
+# processes: number of worker processes (default: one per replica)
+# returns the best badness and parameters found by any replica
+def optimize_tempering(func, init, mins, maxs, method, debug, replicas = 8, rounds = 50, steps = 5,
+                       temps = (0.5, 0.001), scales = (0.2, 0.005), seed = 0, processes = None):
+    mins = np.asarray(mins, dtype=float)
+    maxs = np.asarray(maxs, dtype=float)
+    # every replica and the swap decisions get their own random stream,
+    # so the outcome doesn't depend on how the replicas are scheduled
+    seeds = np.random.SeedSequence(seed).generate_state(replicas + 1)
+    rngs = [np.random.RandomState(s) for s in seeds[:replicas]]
+    swap_rng = np.random.RandomState(seeds[replicas])
+    temp_ladder = np.geomspace(temps[0], temps[1], replicas)
+    scale_ladder = np.geomspace(scales[0], scales[1], replicas)
+
+    badness = func(init, method, debug)
+    states = [(np.array(init, dtype=float), badness)] * replicas
+    best_badness, best_vals = badness, np.array(init, dtype=float)
+    print("%f @ %d replicas: %s" % (badness, replicas, str(best_vals)))
+
+    if processes is None:
+        processes = replicas
+    pool = None
+    if processes > 1:
+        pool = Pool(processes, initializer=_init_worker, initargs=(func,))
+        run = pool.map
+    else:
+        _init_worker(func)
+        run = lambda f, args: list(map(f, args))
+
+    try:
+        swaps = 0
+        for rnd in range(rounds):
+            jobs = [(vals, b, scale_ladder[r], temp_ladder[r], rngs[r], mins, maxs, method, steps)
+                    for r, (vals, b) in enumerate(states)]
+            results = run(_run_replica, jobs)
+            states = []
+            for r, (vals, b, rng, bvals, bb, accepted) in enumerate(results):
+                states.append((vals, b))
+                rngs[r] = rng
+                if bb < best_badness:
+                    best_badness, best_vals = bb, bvals
+                    if debug >= 1:
+                        print("%f @ temp %f (round %d): %s" % (bb, temp_ladder[r], rnd, str(bvals)))
+            # try to swap neighbouring replicas, alternating between even and odd pairs
+            for r in range(rnd % 2, replicas - 1, 2):
+                e_hot, e_cold = _energy(states[r][1]), _energy(states[r + 1][1])
+                log_ratio = (e_hot - e_cold) * (1 / temp_ladder[r] - 1 / temp_ladder[r + 1])
+                if log_ratio >= 0 or swap_rng.uniform() < np.exp(log_ratio):
+                    states[r], states[r + 1] = states[r + 1], states[r]
+                    swaps += 1
+            if debug >= 2:
+                print("round %d: %s, %d swaps" % (rnd, str([b for _, b in states]), swaps))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return best_badness, best_vals